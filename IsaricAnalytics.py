@@ -1,3 +1,4 @@
+import importlib
 import warnings
 
 import numpy as np
@@ -10,17 +11,8 @@ import pandas as pd
 # from bertopic._utils import select_topic_representation
 # from umap import UMAP
 # from sklearn.preprocessing import MinMaxScaler
-import statsmodels.api as sm
-import statsmodels.formula.api as smf
-from lifelines import CoxPHFitter
-from scipy.stats import norm
 
 # from scipy.stats import fisher_exact
-from sklearn.metrics import accuracy_score, classification_report, confusion_matrix
-from sklearn.model_selection import StratifiedKFold
-from sklearn.preprocessing import LabelEncoder, StandardScaler
-from statsmodels.genmod.bayes_mixed_glm import BinomialBayesMixedGLM
-from statsmodels.stats.outliers_influence import variance_inflation_factor
 
 # from sklearn.impute import KNNImputer
 # from sklearn.linear_model import LogisticRegression
@@ -32,6 +24,42 @@ from statsmodels.stats.outliers_influence import variance_inflation_factor
 # import itertools
 # from collections import OrderedDict
 
+# statsmodels, lifelines, scipy and scikit-learn are slow to import, so are
+# imported in the modelling functions that use them, not when the
+# descriptive insight panels import this module. These names are still
+# available as attributes of this module, imported on first access.
+modelling_imports = {
+    'sm': ('statsmodels.api', None),
+    'smf': ('statsmodels.formula.api', None),
+    'CoxPHFitter': ('lifelines', 'CoxPHFitter'),
+    'KaplanMeierFitter': ('lifelines', 'KaplanMeierFitter'),
+    'logrank_test': ('lifelines.statistics', 'logrank_test'),
+    'multivariate_logrank_test': (
+        'lifelines.statistics', 'multivariate_logrank_test'),
+    'norm': ('scipy.stats', 'norm'),
+    'accuracy_score': ('sklearn.metrics', 'accuracy_score'),
+    'classification_report': ('sklearn.metrics', 'classification_report'),
+    'confusion_matrix': ('sklearn.metrics', 'confusion_matrix'),
+    'StratifiedKFold': ('sklearn.model_selection', 'StratifiedKFold'),
+    'LabelEncoder': ('sklearn.preprocessing', 'LabelEncoder'),
+    'StandardScaler': ('sklearn.preprocessing', 'StandardScaler'),
+    'BinomialBayesMixedGLM': (
+        'statsmodels.genmod.bayes_mixed_glm', 'BinomialBayesMixedGLM'),
+    'variance_inflation_factor': (
+        'statsmodels.stats.outliers_influence', 'variance_inflation_factor'),
+}
+
+
+def __getattr__(name):
+    if name not in modelling_imports:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module_name, attribute = modelling_imports[name]
+    value = importlib.import_module(module_name)
+    if attribute is not None:
+        value = getattr(value, attribute)
+    globals()[name] = value
+    return value
+
 ############################################
 ############################################
 # General preprocessing
@@ -763,6 +791,9 @@ def get_modelling_data(
 
 def variance_influence_factor_backwards_elimination(
         data, dictionary, predictors_list, sep='___'):
+    from statsmodels.stats.outliers_influence import (
+        variance_inflation_factor)
+
     df = data.copy()
 
     numeric_ind = (dictionary['field_type'] == 'numeric')
@@ -959,6 +990,9 @@ def execute_glmm_regression(elr_dataframe_df, elr_outcome_str, elr_predictors_li
     Returns:
     - elr_summary_df: DataFrame with the model results.
     """
+    import statsmodels.formula.api as smf
+    from scipy.stats import norm
+    from statsmodels.genmod.bayes_mixed_glm import BinomialBayesMixedGLM
 
     # Builds the formula
     elr_formula_str = elr_outcome_str + ' ~ ' + ' + '.join(elr_predictors_list)
@@ -1139,6 +1173,8 @@ def execute_glm_regression(elr_dataframe_df, elr_outcome_str, elr_predictors_lis
     Returns:
     - summary_df: DataFrame with the model results.
     """
+    import statsmodels.api as sm
+    import statsmodels.formula.api as smf
 
     # Defines the family according to model_type
     if model_type.lower() == 'logistic':
@@ -1271,6 +1307,7 @@ def execute_cox_model(df, duration_col, event_col, predictors, labels=None):
     Returns:
     - summary_df: DataFrame with the results of the Cox model.
     """
+    from lifelines import CoxPHFitter
 
     # Ensure categorical variables are treated appropriately
     categorical_vars = df.select_dtypes(
@@ -1484,6 +1521,12 @@ def lasso_var_sel_binary(df, outcome_col='mapped_outcome', random_state=42):
     Prepare data and select features using binary logistic regression with elastic net penalty.
     Specifically designed for binary outcomes only.
     """
+    from sklearn.linear_model import LogisticRegressionCV
+    from sklearn.metrics import (
+        accuracy_score, classification_report, confusion_matrix)
+    from sklearn.model_selection import StratifiedKFold
+    from sklearn.preprocessing import LabelEncoder, StandardScaler
+
     if outcome_col not in df.columns:
         raise ValueError(f"Outcome column '{outcome_col}' not found in DataFrame")
 
@@ -1811,11 +1854,12 @@ def get_parameter_ranking(logistic, n_top=10):
 
 
 ## KAPLAN MEIER ##
-from lifelines import KaplanMeierFitter
-from lifelines.statistics import logrank_test, multivariate_logrank_test
 
 
 def execute_kaplan_meier(df, duration_col, event_col, group_col):
+    from lifelines import KaplanMeierFitter
+    from lifelines.statistics import logrank_test, multivariate_logrank_test
+
     # Remove rows with missing values in relevant columns
     df = df.dropna(subset=[duration_col, event_col, group_col])
     kmf = KaplanMeierFitter()
@@ -1,10 +1,13 @@
 import os
 import sys
+import json
+import ast
 
 import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objs as go
+import plotly.io as pio
 from plotly.subplots import make_subplots
 
 default_height = 430
@@ -18,7 +21,46 @@ def get_graph_id(graph_id_suffix, suffix, frame=1):
     return graph_id
 
 
+def to_json_compatible(value):
+    '''Convert numpy values (and sets) for json.dump'''
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (np.ndarray, set)):
+        return list(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def write_fig_data(df, path, name):
+    '''Write figure data as parquet or else as csv (parquet needs pyarrow,
+    which is in requirements.txt, and columns with a single type, so e.g.
+    tables mixing counts and text are saved as csv). Returns the filename
+    relative to path.'''
+    filename = name + '.parquet'
+    try:
+        df.to_parquet(os.path.join(path, filename), index=False)
+    except (ImportError, TypeError, ValueError):
+        if os.path.exists(os.path.join(path, filename)):
+            os.remove(os.path.join(path, filename))
+        filename = name + '.csv'
+        df.to_csv(os.path.join(path, filename), index=False)
+    return filename
+
+
+def read_fig_data(path, filename):
+    if filename.endswith('.parquet'):
+        df = pd.read_parquet(os.path.join(path, filename))
+        # Missing values in object columns are read as None, use NaN instead
+        columns = df.select_dtypes(include='object').columns
+        df[columns] = df[columns].where(df[columns].notna(), np.nan)
+    else:
+        df = pd.read_csv(os.path.join(path, filename))
+    return df
+
+
 def save_inputs_to_file(local_args):
+    '''Save the data and arguments of a figure function, so the figure can be
+    recreated (e.g. for the public dashboard). Writes a json manifest
+    <graph_id>_metadata.json and the data as parquet (or csv).'''
     fig_name = sys._getframe(1).f_code.co_name
     data = local_args.pop('df')
     # Convert to list (if not already)
@@ -26,27 +68,71 @@ def save_inputs_to_file(local_args):
     path = local_args['filepath']
     graph_id = get_graph_id(
         local_args['graph_id'], local_args['suffix'], frame=2)
-    fig_data = [
-        graph_id + '_data___' + str(ii) + '.csv'
-        for ii in range(len(data))]
     _ = local_args.pop('filepath')
     _ = local_args.pop('save_inputs')
+    os.makedirs(
+        os.path.dirname(os.path.join(path, graph_id)), exist_ok=True)
+    fig_data = [
+        write_fig_data(data[ii], path, graph_id + '_data___' + str(ii))
+        for ii in range(len(data))]
     metadata = {
         'fig_id': graph_id,
         'fig_name': fig_name,
         'fig_arguments': local_args,
         'fig_data': fig_data,
     }
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(os.path.join(path, graph_id + '_metadata.txt'), 'w') as file:
-        file.write(repr(metadata))
-    for ii in range(len(data)):
-        data[ii].to_csv(
-            os.path.join(path, graph_id + '_data___' + str(ii) + '.csv'),
-            index=False)
+    metadata_file = os.path.join(path, graph_id + '_metadata.json')
+    with open(metadata_file, 'w') as file:
+        json.dump(metadata, file, default=to_json_compatible)
     return data, metadata
 
 
+def save_figure_to_file(fig, graph_id, graph_label, graph_about, filepath):
+    '''Save a finished figure as plotly json, with its label and about text,
+    so it can be shown without rebuilding it'''
+    figure_file = os.path.join(filepath, graph_id + '_figure.json')
+    os.makedirs(os.path.dirname(figure_file), exist_ok=True)
+    figure_json = {
+        'fig_id': graph_id,
+        'graph_label': graph_label,
+        'graph_about': graph_about,
+        'figure': json.loads(pio.to_json(fig, validate=False))}
+    with open(figure_file, 'w') as file:
+        json.dump(figure_json, file)
+    return
+
+
+def load_figure_from_file(filepath, graph_id):
+    '''Load a visual saved by save_figure_to_file, or else recreate it from
+    the inputs saved by save_inputs_to_file. Returns a tuple of
+    (figure, graph_id, graph_label, graph_about), where figure may be a dict
+    in plotly json format.'''
+    figure_file = os.path.join(filepath, graph_id + '_figure.json')
+    if os.path.exists(figure_file):
+        with open(figure_file, 'r') as file:
+            figure_json = json.load(file)
+        visual = (
+            figure_json['figure'], figure_json['fig_id'],
+            figure_json['graph_label'], figure_json['graph_about'])
+        return visual
+    metadata_file = os.path.join(filepath, graph_id + '_metadata.json')
+    if os.path.exists(metadata_file):
+        with open(metadata_file, 'r') as file:
+            metadata = json.load(file)
+    else:
+        # Files saved by earlier versions
+        metadata_file = os.path.join(filepath, graph_id + '_metadata.txt')
+        with open(metadata_file, 'r', encoding='latin-1') as file:
+            metadata = ast.literal_eval(file.read())
+    data = tuple(
+        read_fig_data(filepath, name) for name in metadata['fig_data'])
+    data = data[0] if (len(data) == 1) else data
+    fig_function = globals()[metadata['fig_name']]
+    metadata['fig_arguments']['save_inputs'] = False
+    visual = fig_function(data, **metadata['fig_arguments'])
+    return visual
+
+
 ############################################
 ############################################
 # Figures
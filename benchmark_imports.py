@@ -0,0 +1,85 @@
+'''Check the time taken to import the VERTEX modules from a cold start (a
+new Python process), as this is paid on every dashboard, gunicorn worker and
+batch job start. Each import is timed several times and the median is
+compared with its budget, and the modelling dependencies (statsmodels,
+lifelines, scipy, scikit-learn) must not be imported by modules that don't
+need them. Exits with an error if any check fails, e.g.
+
+    python benchmark_imports.py --repeats 5
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Median cold import time budget (seconds) for each module
+import_budgets = {
+    'IsaricAnalytics': 1.5,
+    'IsaricDraw': 2.5,
+    'descriptive_batch': 3,
+    'projects/ARChetypeCRF_h5nx_synthetic_mf/insight_panels/'
+    'enrolment_details.py': 3,
+}
+
+modelling_modules = ['statsmodels', 'lifelines', 'scipy', 'sklearn']
+
+timing_script = '''
+import importlib.util, json, sys, time
+name = sys.argv[1]
+start_time = time.perf_counter()
+if name.endswith('.py'):
+    spec = importlib.util.spec_from_file_location('panel', name)
+    spec.loader.exec_module(importlib.util.module_from_spec(spec))
+else:
+    importlib.import_module(name)
+duration = time.perf_counter() - start_time
+loaded = sorted(set(x.split('.')[0] for x in sys.modules))
+print(json.dumps({'duration': duration, 'loaded': loaded}))
+'''
+
+
+def time_import(name, repeats=3):
+    '''Import a module (or an insight panel file) in new processes, and
+    return the import times and the top-level modules that were loaded'''
+    durations = []
+    loaded = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, '-c', timing_script, name],
+            check=True, capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        result = json.loads(output.stdout.strip().split('\n')[-1])
+        durations.append(result['duration'])
+        loaded = result['loaded']
+    return durations, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check cold import times against their budgets')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    failed = []
+    for name, budget in import_budgets.items():
+        durations, loaded = time_import(name, repeats=args.repeats)
+        median = statistics.median(durations)
+        modelling_loaded = [x for x in modelling_modules if x in loaded]
+        status = 'ok'
+        if median > budget:
+            status = 'over budget'
+            failed.append(name)
+        elif len(modelling_loaded) > 0:
+            status = f'imports {", ".join(modelling_loaded)}'
+            failed.append(name)
+        print(f'{name}: {median:.2f}s (budget {budget}s) {status}')
+    if len(failed) > 0:
+        print(f'Import checks failed for: {", ".join(failed)}')
+        sys.exit(1)
+    return
+
+
+if __name__ == '__main__':
+    main()
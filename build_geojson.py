@@ -0,0 +1,153 @@
+'''Build and check the country geometry bundled in assets/geojson/, used by
+the dashboard maps at three resolutions (config map_resolution).
+
+The files are built from the Natural Earth 1:10m admin 0 countries, as
+packaged in the datahub.io geo-countries dataset (countries.geojson, with
+ADMIN and ISO_A3 properties; public domain). Each feature keeps only its ISO
+3166 alpha-3 code as id, matching Code in assets/countries.csv. Rebuilding
+needs shapely, which the dashboard itself doesn't, e.g.
+
+    python build_geojson.py --source countries.geojson
+
+Without --source, the bundled files are only checked: every country in
+assets/countries.csv must have a non-empty feature at every resolution.
+Exits with an error if any is missing.
+'''
+import argparse
+import json
+import os
+import sys
+
+import pandas as pd
+
+geojson_path = 'assets/geojson/'
+countries_file = 'assets/countries.csv'
+
+# Simplification tolerance and coordinate precision (degrees), and the area
+# (square degrees) below which islands are dropped, for each resolution
+resolutions = {
+    'high': {'tolerance': 0.02, 'grid_size': 0.001, 'min_area': 0.002},
+    'medium': {'tolerance': 0.05, 'grid_size': 0.01, 'min_area': 0.01},
+    'low': {'tolerance': 0.2, 'grid_size': 0.01, 'min_area': 0.05},
+}
+
+# Codes used in assets/countries.csv for areas without their own ISO_A3 in
+# Natural Earth: names (ADMIN) of features with ISO_A3 -99, and codes made
+# from the union of other features
+admin_codes = {'Kosovo': 'XKX'}
+combined_codes = {'CHI': ['GGY', 'JEY']}
+
+
+def get_source_geometry(source_file):
+    '''Read the source geojson into a dict of ISO code: shapely geometry.
+    Features without an ISO code (-99) are dropped unless in admin_codes.'''
+    import shapely.geometry
+
+    with open(source_file, 'r') as file:
+        source = json.load(file)
+    geometry = {}
+    for feature in source['features']:
+        code = feature['properties']['ISO_A3']
+        if code == '-99':
+            code = admin_codes.get(feature['properties']['ADMIN'])
+        if code is None:
+            continue
+        geometry[code] = shapely.geometry.shape(feature['geometry'])
+    for code, parts in combined_codes.items():
+        geometry[code] = shapely.union_all([geometry[x] for x in parts])
+    return geometry
+
+
+def simplify_geometry(geometry, tolerance, grid_size, min_area):
+    '''Simplify a country's geometry, dropping islands smaller than min_area
+    (but never the largest part, so small states are kept)'''
+    import shapely
+
+    parts = list(getattr(geometry, 'geoms', [geometry]))
+    largest = max(parts, key=lambda x: x.area)
+    parts = [x for x in parts if (x.area >= min_area) or (x is largest)]
+    simplified = shapely.MultiPolygon(parts).simplify(
+        tolerance, preserve_topology=True)
+    simplified = shapely.set_precision(simplified, grid_size)
+    if simplified.is_empty:
+        # Smaller than the precision, so keep its outline at a finer one
+        simplified = shapely.set_precision(largest, grid_size / 10)
+    return simplified
+
+
+def round_coordinates(coordinates, digits):
+    if isinstance(coordinates[0], (int, float)):
+        return [round(x, digits) for x in coordinates]
+    return [round_coordinates(x, digits) for x in coordinates]
+
+
+def build_geojson(source_file, output_path=geojson_path):
+    '''Write the country geometry at each resolution to output_path'''
+    import shapely.geometry
+
+    geometry = get_source_geometry(source_file)
+    for resolution, settings in resolutions.items():
+        # One more digit than the precision, for small states
+        digits = len(f'{settings["grid_size"]:.10g}'.split('.')[1]) + 1
+        features = []
+        for code in sorted(geometry.keys()):
+            simplified = simplify_geometry(geometry[code], **settings)
+            mapping = shapely.geometry.mapping(simplified)
+            features.append({
+                'type': 'Feature',
+                'id': code,
+                'properties': {},
+                'geometry': {
+                    'type': mapping['type'],
+                    'coordinates': round_coordinates(
+                        mapping['coordinates'], digits)}})
+        file = os.path.join(output_path, f'countries_{resolution}.json')
+        with open(file, 'w') as geojson_file:
+            json.dump(
+                {'type': 'FeatureCollection', 'features': features},
+                geojson_file, separators=(',', ':'))
+        print(f'{file}: {len(features)} countries')
+    return
+
+
+def check_geojson(geojson_path=geojson_path, countries_file=countries_file):
+    '''Get the countries in countries_file without a (non-empty) feature, for
+    each resolution'''
+    countries = pd.read_csv(countries_file, encoding='latin-1')
+    missing = {}
+    for resolution in resolutions.keys():
+        file = os.path.join(geojson_path, f'countries_{resolution}.json')
+        with open(file, 'r') as geojson_file:
+            geojson = json.load(geojson_file)
+        codes = set(
+            feature['id'] for feature in geojson['features']
+            if len(feature['geometry']['coordinates']) > 0)
+        missing[resolution] = sorted(set(countries['Code']) - codes)
+    return missing
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build or check the bundled country geometry')
+    parser.add_argument(
+        '--source', default=None,
+        help='''Natural Earth countries geojson to build the files from \
+(default: only check the bundled files)''')
+    args = parser.parse_args()
+
+    if args.source is not None:
+        build_geojson(args.source)
+    missing = check_geojson()
+    failed = False
+    for resolution, codes in missing.items():
+        if len(codes) > 0:
+            print(f'{resolution}: no geometry for {", ".join(codes)}')
+            failed = True
+    if failed:
+        sys.exit(1)
+    print('Every country in assets/countries.csv has geometry')
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,783 @@
+'''Data loading, insight panels and public outputs for VERTEX, without
+Dash. descriptive_dashboard uses these to serve the dashboard, and this
+module can also be run from the command line to save the public dashboard
+outputs for one or more projects, e.g.
+
+    python descriptive_batch.py projects/ARChetypeCRF_h5nx_synthetic_mf/
+'''
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import IsaricDraw as idw
+import getREDCapData as getRC
+
+
+############################################
+# IMPORT
+############################################
+
+
+def import_from_path(module_name, filepath):
+    spec = importlib.util.spec_from_file_location(module_name, filepath)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+############################################
+# CONFIG
+############################################
+
+
+def get_config_defaults():
+    '''Defaults for settings not included in config_file.json'''
+    config_defaults = {
+        'project_name': None,
+        'map_layout_center_latitude': 6,
+        'map_layout_center_longitude': -75,
+        'map_layout_zoom': 1.7,
+        'map_resolution': 'high',
+        'save_public_outputs': False,
+        'save_base_files_to_public_path': False,
+        'public_path': 'PUBLIC/',
+        'save_filtered_public_outputs': False,
+        'public_outputs_workers': 1,
+        'insight_panels_path': 'insight_panels/',
+        'insight_panels': [],
+        'api_batch_size': None,
+        'api_concurrent_requests': False,
+        'api_snapshot_path': None,
+        'vertex_dataframes_path': 'vertex_patient_level_data/',
+        'save_vertex_dataframes': False,
+        'visuals_cache_size': 32,
+        'visuals_cache_max_mb': 256,
+        'visuals_cache_path': None,
+        'visuals_cache_spill_max_mb': 1024,
+        'background_insight_panels': [],
+        'background_workers': 2,
+        'data_refresh_interval': None,
+        'data_refresh_token': None,
+    }
+    return config_defaults
+
+
+def get_config(init_project_path, config_defaults):
+    config_file = os.path.join(init_project_path, 'config_file.json')
+    try:
+        with open(config_file, 'r') as json_data:
+            config_dict = json.load(json_data)
+        _ = config_dict['api_key']
+        _ = config_dict['api_url']
+    except Exception:
+        error_message = f'''config_file.json is required in \
+{init_project_path}. This file must contain both "api_key" and "api_url".'''
+        print(error_message)
+        raise SystemExit
+    # The default for the list of insight panels is all that exist in the
+    # relevant folder (which may or not be specified in config)
+    if 'insight_panels_path' not in config_dict.keys():
+        rel_insight_panels_path = config_defaults['insight_panels_path']
+        config_dict['insight_panels_path'] = rel_insight_panels_path
+    # Get a list of python files in the repository (excluding e.g. __init__.py)
+    insight_panels_path = os.path.join(
+        init_project_path, config_dict['insight_panels_path'])
+    for (_, _, filenames) in os.walk(insight_panels_path):
+        insight_panels = [
+            file.split('.py')[0] for file in filenames
+            if file.endswith('.py') and not file.startswith('_')]
+        break
+    config_defaults['insight_panels'] = insight_panels
+    # Add default items where the config file doesn't include these
+    config_defaults = {
+        k: v
+        for k, v in config_defaults.items() if k not in config_dict.keys()}
+    config_dict = {**config_dict, **config_defaults}
+    if any([x not in insight_panels for x in config_dict['insight_panels']]):
+        print('The following insight panels in config_file.json do not exist:')
+        missing_insight_panels = [
+            x for x in config_dict['insight_panels']
+            if x not in insight_panels]
+        print('\n'.join(missing_insight_panels))
+        print('These are ignored and will not appear in the dashboard.')
+        config_dict['insight_panels'] = [
+            x for x in config_dict['insight_panels'] if x in insight_panels]
+    if any([x not in config_dict['insight_panels'] for x in insight_panels]):
+        print('''The following insight panel files are not listed in \
+config_file.json:''')
+        missing_insight_panels = [
+            x for x in insight_panels
+            if x not in config_dict['insight_panels']]
+        print('\n'.join(missing_insight_panels))
+        print('''These will not appear in the dashboard. Please add them \
+to the list "insight_panels" in config_file.json to include them in \
+the dashboard.''')
+    return config_dict
+
+
+############################################
+# DATA
+############################################
+
+
+def load_data(config_dict, init_project_path):
+    '''Get df_map, df_forms_dict, dictionary and quality_report, either from
+    the API or from previously saved VERTEX dataframes'''
+    api_url = config_dict['api_url']
+    api_key = config_dict['api_key']
+    get_data_from_api = (api_url is not None) and (api_key is not None)
+
+    if get_data_from_api:
+        get_data_kwargs = {
+            'batch_size': config_dict['api_batch_size'],
+            'concurrent': config_dict['api_concurrent_requests']}
+        if config_dict['api_snapshot_path'] is not None:
+            get_data_kwargs['snapshot_path'] = os.path.join(
+                init_project_path, config_dict['api_snapshot_path'])
+        print('Retrieving data from the API')
+        df_map, df_forms_dict, dictionary, quality_report = (
+            getRC.get_redcap_data(api_url, api_key, **get_data_kwargs))
+    else:
+        vertex_dataframes_path = os.path.join(
+            init_project_path, config_dict['vertex_dataframes_path'])
+        try:
+            df_map, df_forms_dict, dictionary, quality_report = (
+                getRC.load_vertex_dataframes(vertex_dataframes_path))
+        except Exception:
+            print('Could not load the VERTEX dataframes.')
+            raise
+    return df_map, df_forms_dict, dictionary, quality_report
+
+
+def merge_data_with_countries(df_map):
+    '''Add country variable to df_map and merge with country metadata.'''
+    contries_path = 'assets/countries.csv'
+    countries = pd.read_csv(contries_path, encoding='latin-1')
+    countries.rename(columns={
+        'Code': 'country_iso',
+        'Country': 'country_name',
+        'Region': 'country_region',
+        'Income group': 'country_income'}, inplace=True)
+    df_map = pd.merge(df_map, countries, on='country_iso', how='left')
+    return df_map
+
+
+def get_countries(df_map):
+    df_countries = df_map[['country_iso', 'country_name', 'subjid']]
+    df_countries = df_countries.groupby(
+        ['country_iso', 'country_name']).count().reset_index()
+    df_countries.rename(columns={'subjid': 'country_count'}, inplace=True)
+    return df_countries
+
+
+def add_filter_columns(df_map, df_forms_dict):
+    '''Add the country columns to df_map, and the filter columns (sex, age,
+    country and outcome of each patient) to df_map and every form. Also
+    returns the number of patients in each country.'''
+    df_map_with_countries = merge_data_with_countries(df_map)
+    df_countries = get_countries(df_map_with_countries)
+
+    filter_columns_dict = {
+        'subjid': 'subjid',
+        'demog_sex': 'filters_sex',
+        'demog_age': 'filters_age',
+        'country_iso': 'filters_country',
+        'outco_binary_outcome': 'filters_outcome'
+    }
+
+    df_filters = df_map_with_countries[filter_columns_dict.keys()].rename(
+        columns=filter_columns_dict)
+    df_filters['filters_age'] = df_filters['filters_age'].astype(float)
+
+    df_map = pd.merge(
+        df_map_with_countries, df_filters, on='subjid', how='left')
+    df_forms_dict = {
+        form: pd.merge(df_form, df_filters, on='subjid', how='left')
+        for form, df_form in df_forms_dict.items()}
+    return df_map, df_forms_dict, df_countries
+
+
+def get_data_version(df_map, df_forms_dict):
+    '''Get a hash of the dataframes, used to identify cached outputs from the
+    same data'''
+    data_hash = hashlib.sha1()
+    for df in [df_map] + [df_forms_dict[k] for k in sorted(df_forms_dict)]:
+        # Hash the values in their own dtypes (object columns with values
+        # that can't be hashed directly are converted to str by pandas)
+        hash_values = pd.util.hash_pandas_object(df, index=False).to_numpy()
+        data_hash.update(hash_values.tobytes())
+        data_hash.update(','.join(df.columns).encode())
+        data_hash.update(','.join(df.dtypes.astype(str)).encode())
+    data_version = data_hash.hexdigest()
+    return data_version
+
+
+############################################
+# FILTERS
+############################################
+
+
+def get_filter_index(df_map, df_forms_dict):
+    '''Precompute the filter values for each patient in df_map and, for each
+    form, the rows belonging to each patient. A filter selection can then be
+    resolved once to patient positions and used to take rows from every
+    dataframe, rather than re-evaluating the filters on each form.'''
+    filter_index = {
+        'sex': pd.factorize(df_map['filters_sex']),
+        'age': df_map['filters_age'].astype(float).to_numpy(),
+        'outcome': pd.factorize(df_map['filters_outcome']),
+        'country': pd.factorize(df_map['filters_country']),
+        'forms': {}}
+    subjid_index = pd.Index(df_map['subjid'])
+    for form, df_form in df_forms_dict.items():
+        # Position in df_map of the patient on each row (-1 if not included)
+        codes = subjid_index.get_indexer(df_form['subjid'])
+        rows = np.flatnonzero(codes >= 0)
+        codes = codes[rows]
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes, minlength=len(df_map))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        # Rows for the patient at position i are rows[offsets[i]:offsets[i+1]]
+        filter_index['forms'][form] = {
+            'rows': rows[order], 'offsets': offsets}
+    return filter_index
+
+
+def get_filter_positions(
+        filter_index, genders, age_range, outcomes, countries):
+    '''Get the positions in df_map of patients matching the filters'''
+    mask = np.ones(len(filter_index['age']), dtype=bool)
+    for key, values in zip(
+            ['sex', 'outcome', 'country'], [genders, outcomes, countries]):
+        codes, uniques = filter_index[key]
+        mask &= np.isin(codes, np.flatnonzero(uniques.isin(values)))
+    age = filter_index['age']
+    with np.errstate(invalid='ignore'):
+        mask &= ((age >= age_range[0]) | np.isnan(age))
+        mask &= ((age <= age_range[1]) | np.isnan(age))
+    positions = np.flatnonzero(mask)
+    return positions
+
+
+def get_form_rows_for_positions(form_index, positions):
+    '''Get the rows of a form for the patients at positions in df_map, in the
+    original row order'''
+    offsets = form_index['offsets']
+    starts = offsets[positions]
+    counts = offsets[positions + 1] - starts
+    # Expand each patient's [start, start + count) into row numbers
+    shifts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    rows = form_index['rows'][np.arange(counts.sum()) + shifts]
+    rows = np.sort(rows)
+    return rows
+
+
+def filter_dataframes(
+        df_map, df_forms_dict, filter_index,
+        genders, age_range, outcomes, countries):
+    '''Filter df_map and all form dataframes using the filter index'''
+    positions = get_filter_positions(
+        filter_index, genders, age_range, outcomes, countries)
+    df_map_filtered = df_map.take(positions).reset_index(drop=True)
+    df_forms_filtered = {}
+    for form, df_form in df_forms_dict.items():
+        rows = get_form_rows_for_positions(
+            filter_index['forms'][form], positions)
+        df_forms_filtered[form] = df_form.take(rows).reset_index(drop=True)
+    return df_map_filtered, df_forms_filtered
+
+
+def get_map_counts(df_map, age_options):
+    '''Count patients by country and each filter value (including missing
+    values), so the map can be filtered without going back to df_map. Ages
+    are counted in buckets between the steps of the age slider (age_options,
+    with keys min, max and step), which gives the same counts as filtering
+    df_map for any age range that the slider can select.'''
+    age = df_map['filters_age'].astype(float)
+    age_min, age_max, step = (age_options[k] for k in ['min', 'max', 'step'])
+    # The slider values either side of each age, so a <= age <= b for a range
+    # [a, b] from the slider if a <= age_low and age_high <= b. Ages on a step
+    # or at the maximum are their own bucket (age_low == age_high).
+    age_low = np.floor((age - age_min) / step) * step + age_min
+    age_high = np.ceil((age - age_min) / step) * step + age_min
+    age_low = age_low.mask(age >= age_max, age_max)
+    age_high = age_high.clip(upper=age_max)
+    columns = [
+        'country_iso', 'country_name', 'filters_sex', 'filters_outcome',
+        'filters_age_low', 'filters_age_high']
+    map_counts = df_map.assign(
+        filters_age_low=age_low, filters_age_high=age_high).groupby(
+        columns, dropna=False).size()
+    map_counts = map_counts.rename('country_count').reset_index()
+    return map_counts
+
+
+def get_filtered_countries(
+        map_counts, genders, age_range, outcomes, countries):
+    '''Get patient counts per country for the filters, from the output of
+    get_map_counts. The age range must be values from the age slider. Returns
+    None if no patients match the filters.'''
+    age_low = map_counts['filters_age_low']
+    age_high = map_counts['filters_age_high']
+    ind = (
+        (map_counts['filters_sex'].isin(genders)) &
+        ((age_low >= age_range[0]) | age_low.isna()) &
+        ((age_high <= age_range[1]) | age_high.isna()) &
+        (map_counts['filters_outcome'].isin(outcomes)) &
+        (map_counts['country_iso'].isin(countries)))
+    if not ind.any():
+        return None
+    df_countries = map_counts.loc[ind].groupby(
+        ['country_iso', 'country_name'])['country_count'].sum().reset_index()
+    return df_countries
+
+
+def get_preset_filters(df_map, preset):
+    '''Get the filter values (as used by filter_dataframes) for a preset
+    dict with any of the keys 'sex', 'age', 'outcome' and 'country'. Missing
+    keys include all values, except missing values, as in the dashboard.'''
+    filters = [
+        preset.get('sex', list(df_map['filters_sex'].dropna().unique())),
+        preset.get('age', [-np.inf, np.inf]),
+        preset.get(
+            'outcome', list(df_map['filters_outcome'].dropna().unique())),
+        preset.get(
+            'country', list(df_map['filters_country'].dropna().unique()))]
+    return filters
+
+
+############################################
+# INSIGHT PANELS
+############################################
+
+
+def get_insight_panel_module_name(suffix, namespace=None):
+    '''Get the module name for an insight panel, within a namespace (e.g.
+    the project) so panels with the same name in different projects can be
+    imported together'''
+    module_name = suffix
+    if namespace is not None:
+        module_name = f'{namespace}.{suffix}'
+    return module_name
+
+
+def get_insight_panels(config_dict, insight_panels_path, namespace=None):
+    # Import insight panels scripts
+    insight_panels = {
+        x: import_from_path(
+            get_insight_panel_module_name(x, namespace),
+            os.path.join(insight_panels_path, x + '.py'))
+        for x in config_dict['insight_panels']}
+    buttons = [
+        {**ip.define_button(), **{'suffix': suffix}}
+        for suffix, ip in insight_panels.items()]
+    return insight_panels, buttons
+
+
+def get_visuals(
+        buttons, insight_panels, df_map, df_forms_dict,
+        dictionary, quality_report, filepath, data_version=None,
+        max_workers=1, timings=None, panels=None, errors=None):
+    '''Save the outputs of each insight panel to filepath for the public
+    dashboard. Panels whose inputs (data, dictionary, quality report and
+    source code) are unchanged since the last export are skipped, and the
+    outputs of each changed panel are written to a staging folder then moved
+    into place, so the public outputs are never partially written. If
+    max_workers > 1, changed panels are run in parallel worker processes.
+    If timings is a dict, the time taken by each panel is added to it (None
+    for skipped panels). If panels is a list of suffixes, only these panels
+    are run, and the previous outputs of other panels are kept. A panel that
+    raises an exception doesn't stop the others: its previous outputs (if
+    any) are kept, so it is run again next time, and the exception is added
+    to errors if this is a dict.'''
+    if timings is None:
+        timings = {}
+    if errors is None:
+        errors = {}
+    if data_version is None:
+        data_version = get_data_version(df_map, df_forms_dict)
+    manifest_file = os.path.join(filepath, 'export_manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as file:
+            manifest = json.load(file)
+    staging_path = os.path.join(filepath, '.staging', '')
+    panel_hashes = {}
+    for ii in range(len(buttons)):
+        suffix = buttons[ii]['suffix']
+        panel_hash = get_panel_hash(
+            insight_panels[suffix], data_version, dictionary, quality_report)
+        previous = manifest.get(suffix, {})
+        if (panels is not None) and (suffix not in panels):
+            if 'graph_ids' in previous:
+                buttons[ii]['graph_ids'] = previous['graph_ids']
+        elif (previous.get('hash') == panel_hash) and os.path.isdir(
+                os.path.join(filepath, suffix)):
+            print(f'{suffix}: unchanged, skipping')
+            buttons[ii]['graph_ids'] = previous['graph_ids']
+            timings[suffix] = None
+        else:
+            panel_hashes[suffix] = panel_hash
+
+    def finish_panel(suffix, graph_ids, duration):
+        timings[suffix] = duration
+        replace_directory(
+            os.path.join(staging_path, suffix), os.path.join(filepath, suffix))
+        for button in buttons:
+            if button['suffix'] == suffix:
+                button['graph_ids'] = graph_ids
+        manifest[suffix] = {
+            'hash': panel_hashes[suffix], 'graph_ids': graph_ids}
+        write_file_if_changed(
+            manifest_file, json.dumps(manifest, indent=1, sort_keys=True))
+        return
+
+    def fail_panel(suffix, error):
+        print(f'{suffix}: failed, keeping previous outputs')
+        traceback.print_exception(error)
+        errors[suffix] = error
+        previous = manifest.get(suffix, {})
+        if ('graph_ids' in previous) and os.path.isdir(
+                os.path.join(filepath, suffix)):
+            for button in buttons:
+                if button['suffix'] == suffix:
+                    button['graph_ids'] = previous['graph_ids']
+        return
+
+    export_inputs = {
+        'insight_panels': insight_panels, 'df_map': df_map,
+        'df_forms_dict': df_forms_dict, 'dictionary': dictionary,
+        'quality_report': quality_report, 'filepath': staging_path}
+    use_processes = (max_workers > 1) and (len(panel_hashes) > 1) and (
+        'fork' in multiprocessing.get_all_start_methods())
+    if use_processes:
+        # Forked workers share the dataframes with this process
+        # (copy-on-write), so only the panel suffixes are sent to them
+        executor = ProcessPoolExecutor(
+            max_workers=min(max_workers, len(panel_hashes)),
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=set_export_inputs, initargs=(export_inputs,))
+        with executor:
+            futures = {
+                executor.submit(run_export_panel, suffix): suffix
+                for suffix in panel_hashes}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as error:
+                    fail_panel(futures[future], error)
+                else:
+                    finish_panel(futures[future], *result)
+    else:
+        set_export_inputs(export_inputs)
+        for suffix in panel_hashes:
+            try:
+                result = run_export_panel(suffix)
+            except Exception as error:
+                fail_panel(suffix, error)
+            else:
+                finish_panel(suffix, *result)
+        set_export_inputs({})
+    shutil.rmtree(staging_path, ignore_errors=True)
+    # Panels that were not selected and have never been exported
+    buttons = [button for button in buttons if 'graph_ids' in button]
+    return buttons
+
+
+# Inputs for run_export_panel, set in each export worker process
+export_inputs = {}
+
+
+def set_export_inputs(inputs):
+    export_inputs.clear()
+    export_inputs.update(inputs)
+    return
+
+
+def run_export_panel(suffix):
+    '''Run an insight panel with save_inputs, saving its outputs to the
+    staging folder in export_inputs. Returns its graph ids and the time
+    taken in seconds.'''
+    start_time = time.time()
+    filepath = export_inputs['filepath']
+    shutil.rmtree(os.path.join(filepath, suffix), ignore_errors=True)
+    os.makedirs(os.path.join(filepath, suffix), exist_ok=True)
+    visuals = export_inputs['insight_panels'][suffix].create_visuals(
+        df_map=export_inputs['df_map'].copy(),
+        df_forms_dict={
+            k: v.copy() for k, v in export_inputs['df_forms_dict'].items()},
+        dictionary=export_inputs['dictionary'].copy(),
+        quality_report=export_inputs['quality_report'],
+        suffix=suffix, filepath=filepath, save_inputs=True)
+    for fig, id, label, about in visuals:
+        idw.save_figure_to_file(fig, id, label, about, filepath)
+    graph_ids = [id for _, id, _, _ in visuals]
+    duration = time.time() - start_time
+    print(f'{suffix}: saved in {duration:.1f}s')
+    return graph_ids, duration
+
+
+def get_panel_source_files(insight_panel):
+    '''Get the source files of an insight panel and of every module it
+    imports from this repository or from its own folder (e.g. IsaricDraw and
+    IsaricAnalytics), following imports of imports'''
+    source_folders = [
+        os.path.dirname(os.path.abspath(__file__)),
+        os.path.dirname(os.path.abspath(insight_panel.__file__))]
+    source_files = []
+    modules = [insight_panel]
+    while len(modules) > 0:
+        module = modules.pop()
+        source_file = os.path.abspath(module.__file__)
+        if source_file in source_files:
+            continue
+        source_files.append(source_file)
+        for value in vars(module).values():
+            # Modules, and functions or classes imported from modules
+            if not isinstance(value, type(sys)):
+                value = sys.modules.get(getattr(value, '__module__', None))
+            source_file = getattr(value, '__file__', None)
+            if (source_file is None) or ('site-packages' in source_file):
+                continue
+            if os.path.dirname(os.path.abspath(source_file)) in (
+                    source_folders):
+                modules.append(value)
+    return sorted(source_files)
+
+
+def get_panel_source_hash(insight_panel):
+    '''Hash the source code that the outputs of an insight panel depend on'''
+    source_hash = hashlib.sha1()
+    for source_file in get_panel_source_files(insight_panel):
+        with open(source_file, 'rb') as file:
+            source_hash.update(file.read())
+    return source_hash.hexdigest()
+
+
+def get_panel_hash(insight_panel, data_version, dictionary, quality_report):
+    '''Hash everything that the outputs of an insight panel depend on'''
+    panel_hash = hashlib.sha1()
+    panel_hash.update(data_version.encode())
+    dictionary_hash = pd.util.hash_pandas_object(
+        dictionary.astype(str), index=False).to_numpy()
+    panel_hash.update(dictionary_hash.tobytes())
+    panel_hash.update(repr(quality_report).encode())
+    panel_hash.update(get_panel_source_hash(insight_panel).encode())
+    return panel_hash.hexdigest()
+
+
+def replace_directory(source, destination):
+    '''Move source to destination, replacing any existing destination'''
+    old_destination = destination.rstrip(os.sep) + '.old'
+    shutil.rmtree(old_destination, ignore_errors=True)
+    if os.path.exists(destination):
+        os.rename(destination, old_destination)
+    os.rename(source, destination)
+    shutil.rmtree(old_destination, ignore_errors=True)
+    return
+
+
+def write_file_if_changed(path, content):
+    '''Write text content to path (via a temporary file), unless the file
+    already has this content. Returns True if the file was written.'''
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            if file.read() == content:
+                return False
+
+    def write_content(name):
+        with open(name, 'w') as file:
+            file.write(content)
+        return
+
+    getRC.replace_file(path, write_content)
+    return True
+
+
+############################################
+# PUBLIC OUTPUTS
+############################################
+
+
+def save_public_outputs(
+        config_dict, public_path, buttons, insight_panels, df_map,
+        df_forms_dict, dictionary, quality_report, df_countries,
+        data_version=None, max_workers=None, save_base_files=None,
+        panels=None, errors=None):
+    '''Save the files for the public dashboard to public_path. Returns the
+    time taken by each insight panel (None for unchanged panels). If panels
+    is a list of suffixes, only these panels are run, and the exceptions
+    raised by failing panels are added to errors (see get_visuals).'''
+    if max_workers is None:
+        max_workers = config_dict['public_outputs_workers']
+    if save_base_files is None:
+        save_base_files = config_dict['save_base_files_to_public_path']
+    print(f'Saving files for public dashboard to "{public_path}"')
+    os.makedirs(
+        os.path.dirname(os.path.join(public_path, 'data', '')),
+        exist_ok=True)
+    timings = {}
+    buttons = get_visuals(
+        [dict(button) for button in buttons], insight_panels,
+        df_map=df_map, df_forms_dict=df_forms_dict,
+        dictionary=dictionary, quality_report=quality_report,
+        filepath=os.path.join(public_path, 'data', ''),
+        data_version=data_version, max_workers=max_workers,
+        timings=timings, panels=panels, errors=errors)
+    if save_base_files:
+        shutil.copy('descriptive_dashboard_public.py', public_path)
+        shutil.copy('IsaricDraw.py', public_path)
+        shutil.copy('requirements.txt', public_path)
+        assets_path = os.path.join(public_path, 'assets/')
+        os.makedirs(os.path.dirname(assets_path), exist_ok=True)
+        shutil.copytree('assets', assets_path, dirs_exist_ok=True)
+    metadata_file = os.path.join(
+        public_path, 'data/dashboard_metadata.json')
+    write_file_if_changed(metadata_file, json.dumps(buttons))
+    data_file = os.path.join(public_path, 'data/dashboard_data.csv')
+    write_file_if_changed(data_file, df_countries.to_csv(index=False))
+    config_json_file = os.path.join(public_path, 'public_config_file.json')
+    save_config_keys = [
+        'project_name', 'map_layout_center_latitude',
+        'map_layout_center_longitude', 'map_layout_zoom',
+        'map_resolution']
+    save_config_dict = {k: config_dict[k] for k in save_config_keys}
+    write_file_if_changed(config_json_file, json.dumps(save_config_dict))
+    return timings
+
+
+def print_timings(timings, total_time):
+    for suffix, duration in timings.items():
+        if duration is None:
+            print(f'    {suffix}: unchanged')
+        else:
+            print(f'    {suffix}: {duration:.1f}s')
+    print(f'    Total: {total_time:.1f}s')
+    return
+
+
+def run_project(
+        init_project_path, panels=None, presets=None, public_path=None,
+        max_workers=None):
+    '''Load the data for a project and save the public dashboard outputs,
+    for all patients and for each of the filter presets (a dict of preset
+    name: preset, see get_preset_filters). If panels is a list of insight
+    panel suffixes, only these panels are run. Presets are saved to
+    presets/<preset name>/ within the public path. Returns the insight
+    panels that failed (see get_visuals).'''
+    start_time = time.time()
+    init_project_path = os.path.join(init_project_path, '')
+    config_dict = get_config(init_project_path, get_config_defaults())
+    if public_path is None:
+        public_path = config_dict['public_path']
+    public_path = os.path.join(init_project_path, public_path)
+
+    insight_panels_path = os.path.join(
+        init_project_path, config_dict['insight_panels_path'])
+    insight_panels, buttons = get_insight_panels(
+        config_dict, insight_panels_path)
+
+    df_map, df_forms_dict, dictionary, quality_report = load_data(
+        config_dict, init_project_path)
+    df_map, df_forms_dict, df_countries = add_filter_columns(
+        df_map, df_forms_dict)
+    print(f'Loaded data in {time.time() - start_time:.1f}s')
+
+    errors = {}
+    timings = save_public_outputs(
+        config_dict, public_path, buttons, insight_panels, df_map,
+        df_forms_dict, dictionary, quality_report, df_countries,
+        max_workers=max_workers, panels=panels, errors=errors)
+    print(f'Saved public outputs for {init_project_path}:')
+    print_timings(timings, time.time() - start_time)
+    failed = list(errors.keys())
+
+    if presets is None:
+        presets = {}
+    if len(presets) > 0:
+        filter_index = get_filter_index(df_map, df_forms_dict)
+    for preset_name, preset in presets.items():
+        preset_start_time = time.time()
+        df_map_filtered, df_forms_filtered = filter_dataframes(
+            df_map, df_forms_dict, filter_index,
+            *get_preset_filters(df_map, preset))
+        preset_countries = get_countries(df_map_filtered)
+        preset_path = os.path.join(public_path, 'presets', preset_name, '')
+        errors = {}
+        timings = save_public_outputs(
+            config_dict, preset_path, buttons, insight_panels,
+            df_map_filtered, df_forms_filtered, dictionary, quality_report,
+            preset_countries, max_workers=max_workers, save_base_files=False,
+            panels=panels, errors=errors)
+        print(f'Saved public outputs for preset "{preset_name}":')
+        print_timings(timings, time.time() - preset_start_time)
+        failed += [f'{preset_name}/{suffix}' for suffix in errors.keys()]
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='''Save the outputs of VERTEX insight panels for the \
+public dashboard, without starting the dashboard.''')
+    parser.add_argument(
+        'projects', nargs='+',
+        help='Project folders, each containing a config_file.json')
+    parser.add_argument(
+        '--panels', nargs='+', default=None,
+        help='Insight panels to run (default: all in config_file.json)')
+    parser.add_argument(
+        '--presets', default=None,
+        help='''JSON file of filter presets, e.g. {"adults": {"age": [18, \
+120]}, "deaths": {"outcome": ["Death"]}}, with keys sex, age, outcome and \
+country''')
+    parser.add_argument(
+        '--public-path', default=None,
+        help='''Output folder, relative to each project folder (default: \
+public_path in config_file.json)''')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='''Number of worker processes for running insight panels \
+(default: public_outputs_workers in config_file.json)''')
+    args = parser.parse_args()
+
+    presets = None
+    if args.presets is not None:
+        with open(args.presets, 'r') as file:
+            presets = json.load(file)
+    # Keep going after a failure, so one project or insight panel doesn't
+    # stop the others from being exported
+    failed = {}
+    for project in args.projects:
+        try:
+            failed_panels = run_project(
+                project, panels=args.panels, presets=presets,
+                public_path=args.public_path, max_workers=args.workers)
+        except (Exception, SystemExit):
+            # get_config raises SystemExit for a missing or invalid config
+            traceback.print_exc()
+            failed_panels = ['(project)']
+        if len(failed_panels) > 0:
+            failed[project] = failed_panels
+    if len(failed) > 0:
+        print('Failed:')
+        for project, failed_panels in failed.items():
+            print(f'    {project}: {", ".join(failed_panels)}')
+        sys.exit(1)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import dash
+import flask
 import json
 from dash import dcc, html, callback_context
 import dash_bootstrap_components as dbc
@@ -7,15 +8,22 @@ import numpy as np
 import pandas as pd
 import plotly.graph_objs as go
 import sys
-# import IsaricDraw as idw
 # import redcap_config as rc_config
 import getREDCapData as getRC
+import descriptive_batch as batch
 # from insight_panels import *
 # from insight_panels.__init__ import __all__ as ip_list
 import os
-import shutil
-import importlib.util
 import webbrowser
+import pickle
+import hashlib
+import tempfile
+import hmac
+import threading
+import time
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 # import dash_auth
 # import flask_caching as fc
 
@@ -29,6 +37,21 @@ import webbrowser
 # init_project_path = 'projects/ARChetypeCRF_h5nx_synthetic/'
 init_project_path = 'projects/ARChetypeCRF_h5nx_synthetic_mf/'
 
+# To serve several projects from one process, list them here (or in the
+# VERTEX_PROJECT_PATHS environment variable). Each is then served at
+# /<project folder>/, with the data for at most max_active_projects
+# (VERTEX_MAX_ACTIVE_PROJECTS) kept in memory, or None for no limit. Data
+# used in the last min_active_seconds (VERTEX_MIN_ACTIVE_SECONDS) isn't
+# evicted, so projects in use at the same time aren't reloaded on every
+# request, at the cost of going over max_active_projects meanwhile.
+init_project_paths = []
+# init_project_paths = [
+#     'projects/ARChetypeCRF_mpox_synthetic/',
+#     'projects/ARChetypeCRF_dengue_synthetic/',
+#     'projects/ARChetypeCRF_h5nx_synthetic_mf/']
+max_active_projects = 2
+min_active_seconds = 300
+
 # def get_project_path():
 #     with open('vertex_projects_path.txt', 'r') as f:
 #         text = f.read()
@@ -42,77 +65,6 @@ init_project_path = 'projects/ARChetypeCRF_h5nx_synthetic_mf/'
 #     return projects_path, init_project_path
 
 
-############################################
-# IMPORT
-############################################
-
-
-def import_from_path(module_name, filepath):
-    spec = importlib.util.spec_from_file_location(module_name, filepath)
-    module = importlib.util.module_from_spec(spec)
-    sys.modules[module_name] = module
-    spec.loader.exec_module(module)
-    return module
-
-
-############################################
-# CONFIG
-############################################
-
-
-def get_config(init_project_path, config_defaults):
-    config_file = os.path.join(init_project_path, 'config_file.json')
-    try:
-        with open(config_file, 'r') as json_data:
-            config_dict = json.load(json_data)
-        _ = config_dict['api_key']
-        _ = config_dict['api_url']
-    except Exception:
-        error_message = f'''config_file.json is required in \
-{init_project_path}. This file must contain both "api_key" and "api_url".'''
-        print(error_message)
-        raise SystemExit
-    # The default for the list of insight panels is all that exist in the
-    # relevant folder (which may or not be specified in config)
-    if 'insight_panels_path' not in config_dict.keys():
-        rel_insight_panels_path = config_defaults['insight_panels_path']
-        config_dict['insight_panels_path'] = rel_insight_panels_path
-    # Get a list of python files in the repository (excluding e.g. __init__.py)
-    insight_panels_path = os.path.join(
-        init_project_path, config_dict['insight_panels_path'])
-    for (_, _, filenames) in os.walk(insight_panels_path):
-        insight_panels = [
-            file.split('.py')[0] for file in filenames
-            if file.endswith('.py') and not file.startswith('_')]
-        break
-    config_defaults['insight_panels'] = insight_panels
-    # Add default items where the config file doesn't include these
-    config_defaults = {
-        k: v
-        for k, v in config_defaults.items() if k not in config_dict.keys()}
-    config_dict = {**config_dict, **config_defaults}
-    if any([x not in insight_panels for x in config_dict['insight_panels']]):
-        print('The following insight panels in config_file.json do not exist:')
-        missing_insight_panels = [
-            x for x in config_dict['insight_panels']
-            if x not in insight_panels]
-        print('\n'.join(missing_insight_panels))
-        print('These are ignored and will not appear in the dashboard.')
-        config_dict['insight_panels'] = [
-            x for x in config_dict['insight_panels'] if x in insight_panels]
-    if any([x not in config_dict['insight_panels'] for x in insight_panels]):
-        print('''The following insight panel files are not listed in \
-config_file.json:''')
-        missing_insight_panels = [
-            x for x in insight_panels
-            if x not in config_dict['insight_panels']]
-        print('\n'.join(missing_insight_panels))
-        print('''These will not appear in the dashboard. Please add them \
-to the list "insight_panels" in config_file.json to include them in \
-the dashboard.''')
-    return config_dict
-
-
 ############################################
 # CACHE DATA
 ############################################
@@ -129,30 +81,449 @@ the dashboard.''')
 #     # End of cache function
 #     return
 
+
+def create_visuals_cache(
+        max_entries=32, max_size_mb=256, spill_path=None, max_spill_mb=1024):
+    '''Create a least-recently-used cache of insight panel outputs. Entries
+    are stored pickled, so the memory used can be bounded by max_size_mb.
+    If spill_path is given, entries evicted from memory are written to disk
+    there and reloaded on request, keeping at most max_spill_mb on disk.'''
+    cache = {
+        'entries': OrderedDict(),
+        'size': 0,
+        'max_entries': max_entries,
+        'max_size': max_size_mb * 1024 * 1024,
+        'spill_path': spill_path,
+        'max_spill_size': max_spill_mb * 1024 * 1024,
+        'hits': 0,
+        'misses': 0,
+        'lock': threading.Lock()}
+    if spill_path is not None:
+        os.makedirs(spill_path, exist_ok=True)
+        prune_visuals_cache_files(cache)
+    return cache
+
+
+def get_visuals_cache_key(suffix, filters, data_version, source_hash=None):
+    '''Get a cache key from the panel suffix, filter values, data version and
+    hash of the panel source code (so outputs of an older version of a panel
+    are not reused from disk after a restart). Filter values are sorted so
+    that the same selection gives the same key, and filters=None is used for
+    the unfiltered data.'''
+    if filters is not None:
+        genders, age_range, outcomes, countries = filters
+        filters = (
+            tuple(sorted(genders)),
+            tuple(float(x) for x in age_range),
+            tuple(sorted(outcomes)),
+            tuple(sorted(countries)))
+    key = (suffix, filters, data_version, source_hash)
+    return key
+
+
+def get_visuals_cache_file(cache, key):
+    key_hash = hashlib.sha1(repr(key).encode()).hexdigest()
+    spill_file = os.path.join(cache['spill_path'], key_hash + '.pkl')
+    return spill_file
+
+
+def get_cached_visuals(cache, key):
+    '''Get the panel output for key, or None if it is not in the cache'''
+    with cache['lock']:
+        value = cache['entries'].get(key)
+        if value is not None:
+            cache['entries'].move_to_end(key)
+    if value is None and cache['spill_path'] is not None:
+        spill_file = get_visuals_cache_file(cache, key)
+        try:
+            with open(spill_file, 'rb') as file:
+                value = file.read()
+            # Mark as recently used, so it is pruned last
+            os.utime(spill_file)
+        except FileNotFoundError:
+            pass
+        if value is not None:
+            set_cached_visuals(cache, key, value=value)
+    with cache['lock']:
+        if value is None:
+            cache['misses'] += 1
+        else:
+            cache['hits'] += 1
+    if value is not None:
+        value = pickle.loads(value)
+    return value
+
+
+def set_cached_visuals(cache, key, visuals=None, value=None):
+    '''Add the panel output for key to the cache, evicting the least recently
+    used entries beyond the maximum number or size'''
+    if value is None:
+        value = pickle.dumps(visuals, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(value) > cache['max_size']:
+        return
+    evicted = []
+    with cache['lock']:
+        if key in cache['entries']:
+            cache['size'] -= len(cache['entries'].pop(key))
+        cache['entries'][key] = value
+        cache['size'] += len(value)
+        while ((len(cache['entries']) > cache['max_entries']) or
+                (cache['size'] > cache['max_size'])):
+            evicted_key, evicted_value = cache['entries'].popitem(last=False)
+            cache['size'] -= len(evicted_value)
+            evicted.append((evicted_key, evicted_value))
+    if (cache['spill_path'] is not None) and (len(evicted) > 0):
+        for evicted_key, evicted_value in evicted:
+
+            def write_function(name):
+                with open(name, 'wb') as file:
+                    file.write(evicted_value)
+                return
+
+            getRC.replace_file(
+                get_visuals_cache_file(cache, evicted_key), write_function)
+        prune_visuals_cache_files(cache)
+    return
+
+
+def prune_visuals_cache_files(cache):
+    '''Remove the least recently used files in the spill folder beyond the
+    maximum spill size (including entries for old data or panel code, which
+    are never requested again)'''
+    spill_files = []
+    for file in os.scandir(cache['spill_path']):
+        if file.name.endswith('.pkl'):
+            try:
+                file_stat = file.stat()
+            except FileNotFoundError:
+                continue
+            spill_files.append(
+                (file_stat.st_mtime, file_stat.st_size, file.path))
+    spill_size = sum(x[1] for x in spill_files)
+    for _, file_size, file_path in sorted(spill_files):
+        if spill_size <= cache['max_spill_size']:
+            break
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        spill_size -= file_size
+    return
+
+
+def clear_visuals_cache(cache):
+    '''Remove all entries held in memory (entries spilled to disk are kept)'''
+    with cache['lock']:
+        cache['entries'].clear()
+        cache['size'] = 0
+    return
+
+
+def get_visuals_cache_info(cache):
+    '''Get hit/miss counts and current size of the cache'''
+    with cache['lock']:
+        lookups = cache['hits'] + cache['misses']
+        cache_info = {
+            'hits': cache['hits'],
+            'misses': cache['misses'],
+            'hit_rate': cache['hits'] / lookups if lookups else None,
+            'entries': len(cache['entries']),
+            'size_mb': cache['size'] / (1024 * 1024)}
+    return cache_info
+
+
+def get_or_create_visuals(
+        cache, key, insight_panel, df_map, df_forms_dict, dictionary,
+        quality_report, filepath, suffix, save_inputs, copy_data=True):
+    '''Get the panel output from the cache, or create it and add it to the
+    cache. The cache is not used when saving inputs, as create_visuals then
+    also writes files. Set copy_data=False if the dataframes are already
+    copies that the insight panel can modify.'''
+    use_cache = (cache is not None) and (cache['max_entries'] > 0)
+    use_cache = use_cache and (save_inputs is False)
+    visuals = get_cached_visuals(cache, key) if use_cache else None
+    if visuals is None:
+        if copy_data:
+            df_map = df_map.copy()
+            df_forms_dict = {k: v.copy() for k, v in df_forms_dict.items()}
+        visuals = insight_panel.create_visuals(
+            df_map=df_map, df_forms_dict=df_forms_dict,
+            dictionary=dictionary.copy(), quality_report=quality_report,
+            filepath=filepath, suffix=suffix, save_inputs=save_inputs)
+        if use_cache:
+            set_cached_visuals(cache, key, visuals=visuals)
+    return visuals
+
 ############################################
-# MAP
+# BACKGROUND JOBS
 ############################################
 
 
-def merge_data_with_countries(df_map):
-    '''Add country variable to df_map and merge with country metadata.'''
-    contries_path = 'assets/countries.csv'
-    countries = pd.read_csv(contries_path, encoding='latin-1')
-    countries.rename(columns={
-        'Code': 'country_iso',
-        'Country': 'country_name',
-        'Region': 'country_region',
-        'Income group': 'country_income'}, inplace=True)
-    df_map = pd.merge(df_map, countries, on='country_iso', how='left')
-    return df_map
+def create_background_jobs(
+        insight_panels_path, max_workers=2, namespace=None, max_results=16,
+        path=None):
+    '''Create the state for running slow insight panels in a worker pool.
+    The pool itself is only started on the first job, so that it is created
+    in the process that serves requests (e.g. after a gunicorn fork).
+
+    Running jobs and their results are recorded in files in path (a new
+    temporary folder if None), so that every server process sharing it (e.g.
+    gunicorn workers forked after this is created) can report on a job, and
+    doesn't start it again. Results are kept for up to max_results finished
+    jobs that have not been collected.'''
+    if path is None:
+        path = tempfile.mkdtemp(prefix='vertex_background_jobs_')
+    os.makedirs(path, exist_ok=True)
+    jobs = {
+        'insight_panels_path': insight_panels_path,
+        'namespace': namespace,
+        'max_workers': max_workers,
+        'executor': None,
+        'use_processes': 'fork' in multiprocessing.get_all_start_methods(),
+        'data_version': None,
+        'path': path,
+        'futures': {},
+        'started': {},
+        'durations': {},
+        'max_results': max_results,
+        'lock': threading.Lock()}
+    return jobs
+
+
+def get_background_job_file(jobs, key, extension):
+    key_hash = hashlib.sha1(repr(key).encode()).hexdigest()
+    job_file = os.path.join(jobs['path'], f'{key_hash}.{extension}')
+    return job_file
+
+
+def get_background_job_start(jobs, key):
+    '''Get the start time of the running job for key, in any server process
+    sharing the jobs path, or None if it is not running. A job is no longer
+    running if the process that started it has exited.'''
+    try:
+        with open(get_background_job_file(jobs, key, 'running'), 'r') as file:
+            pid, started = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    return started
+
 
+# Inputs for run_background_visuals, set in each background worker process
+# for each project (the namespace of its insight panels)
+background_inputs = {}
 
-def get_countries(df_map):
-    df_countries = df_map[['country_iso', 'country_name', 'subjid']]
-    df_countries = df_countries.groupby(
-        ['country_iso', 'country_name']).count().reset_index()
-    df_countries.rename(columns={'subjid': 'country_count'}, inplace=True)
-    return df_countries
+
+def set_background_inputs(namespace, inputs):
+    background_inputs[namespace] = inputs
+    return
+
+
+def get_background_executor(jobs, data):
+    '''Get the worker pool for jobs on this version of the data. Workers are
+    forked with the data already in memory (shared copy-on-write), so a new
+    pool is started when the data changes. Jobs still running in the
+    previous pool finish there.'''
+    old_executor = None
+    with jobs['lock']:
+        if (jobs['executor'] is None) or (
+                jobs['data_version'] != data['data_version']):
+            old_executor = jobs['executor']
+            if jobs['use_processes']:
+                inputs = {
+                    'data': data,
+                    'insight_panels_path': jobs['insight_panels_path']}
+                # Forked workers already have the insight panels imported
+                jobs['executor'] = ProcessPoolExecutor(
+                    max_workers=jobs['max_workers'],
+                    mp_context=multiprocessing.get_context('fork'),
+                    initializer=set_background_inputs,
+                    initargs=(jobs['namespace'], inputs))
+            else:
+                jobs['executor'] = ThreadPoolExecutor(
+                    max_workers=jobs['max_workers'])
+            jobs['data_version'] = data['data_version']
+        executor = jobs['executor']
+    if old_executor is not None:
+        old_executor.shutdown(wait=False)
+    return executor
+
+
+def run_background_visuals(
+        namespace, suffix, filters, filepath, inputs=None):
+    '''Create the visuals for an insight panel in a worker. The data is
+    taken from background_inputs (set when the worker process started), or
+    from inputs if given (for worker threads, which share memory anyway).'''
+    if inputs is None:
+        inputs = background_inputs[namespace]
+    data = inputs['data']
+    module_name = batch.get_insight_panel_module_name(suffix, namespace)
+    if module_name in sys.modules:
+        insight_panel = sys.modules[module_name]
+    else:
+        insight_panel = batch.import_from_path(
+            module_name,
+            os.path.join(inputs['insight_panels_path'], suffix + '.py'))
+    if filters is None:
+        # Copies, so that the insight panel can't modify the data used by
+        # later jobs in this worker
+        df_map = data['df_map'].copy()
+        df_forms_dict = {k: v.copy() for k, v in data['df_forms_dict'].items()}
+    else:
+        df_map, df_forms_dict = batch.filter_dataframes(
+            data['df_map'], data['df_forms_dict'], data['filter_index'],
+            *filters)
+    visuals = insight_panel.create_visuals(
+        df_map=df_map, df_forms_dict=df_forms_dict,
+        dictionary=data['dictionary'].copy(),
+        quality_report=data['quality_report'],
+        filepath=filepath, suffix=suffix, save_inputs=False)
+    return visuals
+
+
+def submit_background_visuals(
+        jobs, cache, key, suffix, filters, data, filepath):
+    '''Start a job to create the visuals for key (a panel and filters on
+    this version of the data), unless a job for the same key is already
+    running, and return its future (None if the job is running in another
+    server process). Only the panel and filters are sent to the worker,
+    which already has the data. When the job finishes, its result is saved
+    before the job is removed, so the same job is not submitted again in
+    between.'''
+    with jobs['lock']:
+        future = jobs['futures'].get(key)
+    if future is not None:
+        return future
+    if get_background_job_start(jobs, key) is not None:
+        return None
+    executor = get_background_executor(jobs, data)
+    inputs = None
+    if jobs['use_processes'] is False:
+        inputs = {
+            'data': data, 'insight_panels_path': jobs['insight_panels_path']}
+    with jobs['lock']:
+        if key in jobs['futures']:
+            return jobs['futures'][key]
+        started = time.time()
+
+        def write_running_file(name):
+            with open(name, 'w') as file:
+                json.dump([os.getpid(), started], file)
+            return
+
+        getRC.replace_file(
+            get_background_job_file(jobs, key, 'running'), write_running_file)
+        future = executor.submit(
+            run_background_visuals, jobs['namespace'], suffix, filters,
+            filepath, inputs)
+        jobs['futures'][key] = future
+        jobs['started'][key] = started
+
+    def finish_job(future):
+        error = future.exception()
+        visuals = future.result() if error is None else None
+        if (error is None) and (cache is not None) and (
+                cache['max_entries'] > 0):
+            set_cached_visuals(cache, key, visuals=visuals)
+        try:
+            value = pickle.dumps(
+                (visuals, error), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            value = pickle.dumps((None, RuntimeError(repr(error))))
+
+        def write_function(name):
+            with open(name, 'wb') as file:
+                file.write(value)
+            return
+
+        # The result is saved before the running file is removed, so that a
+        # job is always either running or has a result
+        getRC.replace_file(
+            get_background_job_file(jobs, key, 'result'), write_function)
+        prune_background_results(jobs)
+        with jobs['lock']:
+            duration = time.time() - jobs['started'].pop(key, time.time())
+            if error is None:
+                jobs['durations'][suffix] = duration
+            try:
+                os.remove(get_background_job_file(jobs, key, 'running'))
+            except FileNotFoundError:
+                pass
+            jobs['futures'].pop(key, None)
+        return
+
+    future.add_done_callback(finish_job)
+    return future
+
+
+def get_background_progress(jobs, started, suffix):
+    '''Estimate the progress (0-100) of a running job, from its start time
+    and the duration of the last job for the same panel in this process.
+    Returns the progress and elapsed time, with progress None if there is no
+    previous job to compare with.'''
+    elapsed = time.time() - started
+    with jobs['lock']:
+        expected = jobs['durations'].get(suffix)
+    progress = None
+    if expected is not None and expected > 0:
+        progress = min(95, int(100 * elapsed / expected))
+    return progress, elapsed
+
+
+def pop_background_result(jobs, key):
+    '''Get and remove the result of a finished job for key, from any server
+    process sharing the jobs path. Returns (visuals, error), both None if
+    there is no result (the job is still running, or the result was already
+    collected).'''
+    result_file = get_background_job_file(jobs, key, 'result')
+    try:
+        with open(result_file, 'rb') as file:
+            visuals, error = pickle.load(file)
+    except FileNotFoundError:
+        return None, None
+    try:
+        os.remove(result_file)
+    except FileNotFoundError:
+        pass
+    return visuals, error
+
+
+def prune_background_results(jobs):
+    '''Remove the oldest uncollected results beyond max_results'''
+    result_files = []
+    for file in os.scandir(jobs['path']):
+        if file.name.endswith('.result'):
+            try:
+                result_files.append((file.stat().st_mtime, file.path))
+            except FileNotFoundError:
+                continue
+    for _, file_path in sorted(result_files)[:-jobs['max_results']]:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+    return
+
+
+def stop_background_jobs(jobs):
+    '''Shut down the worker pool once its running jobs have finished. A new
+    pool is started if another job is submitted.'''
+    with jobs['lock']:
+        executor = jobs['executor']
+        jobs['executor'] = None
+    if executor is not None:
+        executor.shutdown(wait=False)
+    return
+
+
+############################################
+# MAP
+############################################
 
 
 def interpolate_colors(colors, n):
@@ -213,23 +584,23 @@ def get_map_colorscale(
     return custom_scale
 
 
-def create_map(df_countries, map_layout_dict=None):
-    geojson = os.path.join(
-        'https://raw.githubusercontent.com/',
-        'martynafford/natural-earth-geojson/master/',
-        '50m/cultural/ne_50m_admin_0_countries.json')
-    # geojson = os.path.join(
-    #     'https://raw.githubusercontent.com/',
-    #     'datasets/geo-countries/blob/main/data/countries.geojson')
-    # geojson = os.path.join(
-    #     'https://raw.githubusercontent.com/',
-    #     'johan/world.geo.json/master/countries.geo.json')
+def get_geojson_url(app, map_resolution='high'):
+    '''Get the URL of the bundled country geometry (assets/geojson/), at
+    resolution 'high', 'medium' or 'low'. Figures reference this URL rather
+    than including the geometry, so the browser downloads it once.'''
+    geojson = app.get_asset_url(f'geojson/countries_{map_resolution}.json')
+    return geojson
+
 
+def create_map(
+        df_countries, map_layout_dict=None,
+        geojson='/assets/geojson/countries_high.json'):
     map_colorscale = get_map_colorscale(df_countries)
 
+    # Features in the bundled geojson have the ISO 3166 alpha-3 code as id
     fig = go.Figure(go.Choroplethmap(
         geojson=geojson,
-        featureidkey='properties.ADM0_A3',
+        featureidkey='id',
         locations=df_countries['country_iso'],
         z=df_countries['country_count'],
         text=df_countries['country_name'],
@@ -378,6 +749,9 @@ def define_app_layout(
     app_layout = html.Div([
         dcc.Store(id='button', data={'item': '', 'label': '', 'suffix': ''}),
         dcc.Store(id='map-layout', data=map_layout_dict),
+        dcc.Store(id='background-job', data=None),
+        dcc.Interval(
+            id='background-job-interval', interval=1000, disabled=True),
         # dcc.Store(id='button', data=buttons),
         dcc.Graph(
             id='world-map', figure=fig,
@@ -438,42 +812,47 @@ def generate_html_text(text):
 
 
 ############################################
-# Get insight panels
+# Modal creation
 ############################################
 
-def get_insight_panels(config_dict, insight_panels_path):
-    # Import insight panels scripts
-    insight_panels = {
-        x: import_from_path(x, os.path.join(insight_panels_path, x + '.py'))
-        for x in config_dict['insight_panels']}
-    buttons = [
-        {**ip.define_button(), **{'suffix': suffix}}
-        for suffix, ip in insight_panels.items()]
-    return insight_panels, buttons
-
-
-def get_visuals(
-        buttons, insight_panels, df_map, df_forms_dict,
-        dictionary, quality_report, filepath):
-    for ii in range(len(buttons)):
-        suffix = buttons[ii]['suffix']
-        visuals = insight_panels[suffix].create_visuals(
-            df_map=df_map.copy(),
-            df_forms_dict={k: v.copy() for k, v in df_forms_dict.items()},
-            dictionary=dictionary.copy(), quality_report=quality_report,
-            suffix=suffix, filepath=filepath, save_inputs=True)
-        buttons[ii]['graph_ids'] = [id for _, id, _, _ in visuals]
-    return buttons
-
 
-############################################
-# Modal creation
-############################################
+def define_loading_layout(project_name=None):
+    '''Page shown while the project data is loaded in the background, which
+    is replaced by the dashboard once it has loaded'''
+    title = 'VERTEX - Visual Evidence & Research Tool for EXploration'
+    message = 'Loading the data'
+    if project_name is not None:
+        message += f' for {project_name}'
+    loading_layout = html.Div(
+        [
+            html.H1(title),
+            dbc.Spinner(html.P(message + '...')),
+            dcc.Interval(id='loading-interval', interval=2000)],
+        id='project-content',
+        style={'margin': '20px'})
+    return loading_layout
+
+
+def define_background_progress(progress=None, elapsed=0):
+    '''Progress bar shown in the modal while a background job is running'''
+    if progress is None:
+        # Unknown duration, so show an animated full bar
+        progress_bar = dbc.Progress(
+            id='background-job-progress', value=100, striped=True,
+            animated=True, label=f'{elapsed:.0f}s')
+    else:
+        progress_bar = dbc.Progress(
+            id='background-job-progress', value=progress, striped=True,
+            animated=True, label=f'{progress}%')
+    progress_div = html.Div([
+        html.P('Running the analysis for this insight panel...'),
+        progress_bar])
+    return progress_div
 
 
-def create_modal(visuals, button, filter_options):
+def create_modal(visuals, button, filter_options, progress_div=None):
     if visuals is None:
-        insight_children = []
+        insight_children = [] if progress_div is None else [progress_div]
         about_str = ''
     else:
         insight_children = [
@@ -693,9 +1072,66 @@ def define_footer_modal(instructions, about):
 
 
 def register_callbacks(
-        app, insight_panels, df_map,
-        df_forms_dict, dictionary, quality_report, filter_options,
-        filepath, save_inputs):
+        app, insight_panels, data_holder, filepath, save_inputs,
+        visuals_cache=None, background_jobs=None,
+        background_insight_panels=None):
+    '''Register the dashboard callbacks. Each callback gets the current data
+    from data_holder once, so it uses the same version of the data
+    throughout even if the data is refreshed while it runs.'''
+    if background_insight_panels is None:
+        background_insight_panels = []
+    # Cached outputs are keyed by the panel code as well as the data
+    panel_source_hashes = {
+        suffix: batch.get_panel_source_hash(insight_panel)
+        for suffix, insight_panel in insight_panels.items()}
+
+    def get_panel_visuals(data, suffix, filters):
+        '''Get the visuals for a panel and filters (None if unfiltered).
+        Returns (visuals, job), where job describes a background job to poll
+        if visuals is None. If all dataframes are empty, returns (None, None)
+        '''
+        df_map = data['df_map']
+        df_forms_dict = data['df_forms_dict']
+        dictionary = data['dictionary']
+        quality_report = data['quality_report']
+        if filters is None:
+            df_map_filtered, df_forms_filtered = df_map, df_forms_dict
+            copy_data = True
+            panel_save_inputs = False
+        else:
+            df_map_filtered, df_forms_filtered = batch.filter_dataframes(
+                df_map, df_forms_dict, data['filter_index'], *filters)
+            copy_data = False
+            panel_save_inputs = save_inputs
+            # If all dataframes in the dict are empty, return an empty modal
+            df_list = [df_map_filtered] + list(df_forms_filtered.values())
+            if all([x.empty for x in df_list]):
+                return None, None
+        key = get_visuals_cache_key(
+            suffix, filters, data['data_version'],
+            source_hash=panel_source_hashes[suffix])
+        use_background = (background_jobs is not None) and (
+            suffix in background_insight_panels) and (
+            panel_save_inputs is False)
+        if use_background:
+            visuals = None
+            if visuals_cache is not None and visuals_cache['max_entries'] > 0:
+                visuals = get_cached_visuals(visuals_cache, key)
+            if visuals is None:
+                submit_background_visuals(
+                    background_jobs, visuals_cache, key, suffix, filters,
+                    data, filepath)
+                job = {'suffix': suffix, 'filters': filters}
+                return None, job
+        else:
+            visuals = get_or_create_visuals(
+                visuals_cache, key, insight_panels[suffix],
+                df_map=df_map_filtered, df_forms_dict=df_forms_filtered,
+                dictionary=dictionary, quality_report=quality_report,
+                filepath=filepath, suffix=suffix,
+                save_inputs=panel_save_inputs, copy_data=copy_data)
+        return visuals, None
+
     @app.callback(
         Output('world-map', 'figure'),
         [
@@ -708,36 +1144,19 @@ def register_callbacks(
         prevent_initial_call=True
     )
     def update_map(genders, age_range, outcomes, countries, map_layout_dict):
-        df_map['filters_age'] = df_map['filters_age'].astype(float)
-        df_map_filtered = df_map[(
-            (df_map['filters_sex'].isin(genders)) &
-            ((
-                df_map['filters_age'] >= age_range[0]) |
-                df_map['filters_age'].isna()) &
-            ((
-                df_map['filters_age'] <= age_range[1]) |
-                df_map['filters_age'].isna()) &
-            (df_map['filters_outcome'].isin(outcomes)) &
-            (df_map['filters_country'].isin(countries)))]
-        if df_map_filtered.empty:
-            geojson = os.path.join(
-                'https://raw.githubusercontent.com/',
-                'martynafford/natural-earth-geojson/master/',
-                '50m/cultural/ne_50m_admin_0_map_units.json')
-            #
-            # geojson = os.path.join(
-            #     'https://raw.githubusercontent.com/',
-            #     'johan/world.geo.json/master/countries.geo.json')
-
+        data = get_current_data(data_holder)
+        df_countries = batch.get_filtered_countries(
+            data['map_counts'], genders, age_range, outcomes, countries)
+        if df_countries is None:
             fig = go.Figure(
                 go.Choroplethmap(
-                    geojson=geojson,
-                    featureidkey='properties.ISO_A3'
+                    geojson=data['geojson'],
+                    featureidkey='id'
                 ),
                 layout=map_layout_dict)
         else:
-            df_countries = get_countries(df_map_filtered)
-            fig = create_map(df_countries, map_layout_dict)
+            fig = create_map(
+                df_countries, map_layout_dict, geojson=data['geojson'])
         return fig
 
     @app.callback(
@@ -827,7 +1246,10 @@ def register_callbacks(
             Output('modal', 'is_open', allow_duplicate=True),
             Output('modal', 'children', allow_duplicate=True),
             Output('modal', 'scrollable', allow_duplicate=True),
-            Output('button', 'data')
+            Output('button', 'data'),
+            Output('background-job', 'data', allow_duplicate=True),
+            Output('background-job-interval', 'disabled',
+                   allow_duplicate=True)
         ],
         [Input({'type': 'open-modal', 'index': ALL}, 'n_clicks')],
         [State('modal', 'is_open')],
@@ -837,19 +1259,22 @@ def register_callbacks(
         ctx = callback_context
         if not ctx.triggered:
             empty_button = {'item': '', 'label': '', 'suffix': ''}
-            output = is_open, [], False, empty_button
+            output = is_open, [], False, empty_button, None, True
         else:
             button_id = ctx.triggered[0]['prop_id'].split('.')[0]
             suffix = json.loads(button_id)['index']
-            visuals = insight_panels[suffix].create_visuals(
-                df_map=df_map.copy(),
-                df_forms_dict={k: v.copy() for k, v in df_forms_dict.items()},
-                dictionary=dictionary.copy(), quality_report=quality_report,
-                suffix=suffix, filepath=filepath, save_inputs=False)
+            data = get_current_data(data_holder)
+            visuals, job = get_panel_visuals(data, suffix, None)
             button = {
                 **insight_panels[suffix].define_button(), **{'suffix': suffix}}
-            modal = create_modal(visuals, button, filter_options)
-            output = not is_open, modal, True, button
+            progress_div = None
+            if job is not None:
+                progress_div = define_background_progress()
+            modal = create_modal(
+                visuals, button, data['filter_options'],
+                progress_div=progress_div)
+            output = (
+                not is_open, modal, True, button, job, job is None)
         return output
 
     @app.callback(
@@ -940,7 +1365,10 @@ def register_callbacks(
             Output('gender-checkboxes-modal', 'value', allow_duplicate=True),
             Output('age-slider-modal', 'value', allow_duplicate=True),
             Output('outcome-checkboxes-modal', 'value', allow_duplicate=True),
-            Output('country-checkboxes-modal', 'value', allow_duplicate=True)
+            Output('country-checkboxes-modal', 'value', allow_duplicate=True),
+            Output('background-job', 'data', allow_duplicate=True),
+            Output('background-job-interval', 'disabled',
+                   allow_duplicate=True)
         ],
         [Input('submit-button-modal', 'n_clicks')],
         [
@@ -954,52 +1382,86 @@ def register_callbacks(
     )
     def update_figures(
             click, button, genders, age_range, outcomes, countries):
-        df_map['filters_age'] = df_map['filters_age'].astype(float)
-        df_map_filtered = df_map[(
-            (df_map['filters_sex'].isin(genders)) &
-            ((
-                df_map['filters_age'] >= age_range[0]) |
-                df_map['filters_age'].isna()) &
-            ((
-                df_map['filters_age'] <= age_range[1]) |
-                df_map['filters_age'].isna()) &
-            (df_map['filters_outcome'].isin(outcomes)) &
-            (df_map['filters_country'].isin(countries)))]
-        df_map_filtered = df_map_filtered.reset_index(drop=True)
-
-        df_forms_filtered = df_forms_dict.copy()
-        for key in df_forms_filtered.keys():
-            df_filtered = df_forms_filtered[key].copy()
-            df_filtered['filters_age'] = (
-                df_filtered['filters_age'].astype(float))
-            df_filtered = df_filtered[(
-                (df_filtered['filters_sex'].isin(genders)) &
-                ((
-                    df_filtered['filters_age'] >= age_range[0]) |
-                    df_filtered['filters_age'].isna()) &
-                ((
-                    df_filtered['filters_age'] <= age_range[1]) |
-                    df_filtered['filters_age'].isna()) &
-                (df_filtered['filters_outcome'].isin(outcomes)) &
-                (df_filtered['filters_country'].isin(countries)))]
-            df_forms_filtered[key] = df_filtered.reset_index(drop=True)
-
         suffix = button['suffix']
-        # If all dataframes in the dict are empty, return an empty modal
-        df_list = [df_map_filtered] + list(df_forms_filtered.values())
-        if all([x.empty for x in df_list]):
+        filters = [genders, age_range, outcomes, countries]
+        data = get_current_data(data_holder)
+        filter_options = data['filter_options']
+        visuals, job = get_panel_visuals(data, suffix, filters)
+        if job is not None:
+            job['button'] = button
+            modal = create_modal(
+                None, button, filter_options,
+                progress_div=define_background_progress())
+        elif visuals is None:
             modal = ()
         else:
-            visuals = insight_panels[suffix].create_visuals(
-                df_map=df_map_filtered.copy(),
-                df_forms_dict={
-                    k: v.copy() for k, v in df_forms_filtered.items()},
-                dictionary=dictionary.copy(),
-                quality_report=quality_report,
-                filepath=filepath, suffix=suffix,
-                save_inputs=save_inputs)
             modal = create_modal(visuals, button, filter_options)
-        output = modal, genders, age_range, outcomes, countries
+        output = (
+            modal, genders, age_range, outcomes, countries, job, job is None)
+        return output
+
+    @app.callback(
+        [
+            Output('modal', 'children', allow_duplicate=True),
+            Output('gender-checkboxes-modal', 'value', allow_duplicate=True),
+            Output('age-slider-modal', 'value', allow_duplicate=True),
+            Output('outcome-checkboxes-modal', 'value', allow_duplicate=True),
+            Output('country-checkboxes-modal', 'value', allow_duplicate=True),
+            Output('background-job-progress', 'value'),
+            Output('background-job-progress', 'label'),
+            Output('background-job-interval', 'disabled',
+                   allow_duplicate=True)
+        ],
+        [Input('background-job-interval', 'n_intervals')],
+        [State('background-job', 'data'), State('button', 'data')],
+        prevent_initial_call=True
+    )
+    def update_background_job(n_intervals, job, button):
+        no_update = dash.no_update
+        if job is None:
+            return (no_update,) * 7 + (True,)
+        suffix = job['suffix']
+        filters = job['filters']
+        button = job.get('button', button)
+        data = get_current_data(data_holder)
+        filter_options = data['filter_options']
+        key = get_visuals_cache_key(
+            suffix, filters, data['data_version'],
+            source_hash=panel_source_hashes[suffix])
+        # Jobs and results are shared by all server processes, so the job
+        # may have been started by another one
+        started = get_background_job_start(background_jobs, key)
+        if started is not None:
+            progress, elapsed = get_background_progress(
+                background_jobs, started, suffix)
+            if progress is None:
+                progress_output = (100, f'{elapsed:.0f}s')
+            else:
+                progress_output = (progress, f'{progress}%')
+            output = (no_update,) * 5 + progress_output + (False,)
+            return output
+        visuals, error = pop_background_result(background_jobs, key)
+        if (visuals is not None) and (visuals_cache is not None) and (
+                visuals_cache['max_entries'] > 0):
+            set_cached_visuals(visuals_cache, key, visuals=visuals)
+        if (visuals is None) and (error is None):
+            # The result was already collected (e.g. in another request), or
+            # its process exited before the job finished, so get it again
+            visuals, new_job = get_panel_visuals(data, suffix, filters)
+            if new_job is not None:
+                return (no_update,) * 5 + (100, '', False)
+        if error is not None:
+            print(f'Insight panel {suffix} failed: {error!r}')
+            modal = create_modal(
+                None, button, filter_options,
+                progress_div=html.P('This insight panel could not be run.'))
+        else:
+            modal = create_modal(visuals, button, filter_options)
+        if filters is None:
+            filter_values = (no_update,) * 4
+        else:
+            filter_values = tuple(filters)
+        output = (modal,) + filter_values + (no_update, no_update, True)
         return output
 
     # @dash.callback(
@@ -1019,16 +1481,332 @@ def register_callbacks(
     return
 
 
+############################################
+# Data
+############################################
+
+
+def get_filter_options(df_map, df_countries):
+    sex_options = [
+        {'label': 'Male', 'value': 'Male'},
+        {'label': 'Female', 'value': 'Female'},
+        {'label': 'Other / Unknown', 'value': 'Other / Unknown'}]
+
+    max_age = max((100, df_map['demog_age'].max()))
+    age_options = {'min': 0, 'max': max_age, 'step': 10}
+    age_range = range(
+        age_options['min'], age_options['max'] + 1, age_options['step'])
+    age_options['marks'] = {ii: str(ii) for ii in age_range}
+    age_options['value'] = [age_options['min'], age_options['max']]
+
+    country_options = [
+        {'label': x[1], 'value': x[0]}
+        for x in df_countries.sort_values(by='country_iso').values]
+
+    outcome_options = [
+        {'label': 'Death', 'value': 'Death'},
+        {'label': 'Censored', 'value': 'Censored'},
+        {'label': 'Discharged', 'value': 'Discharged'}
+    ]
+
+    filter_options = {
+        'sex_options': sex_options, 'age_options': age_options,
+        'country_options': country_options, 'outcome_options': outcome_options}
+    return filter_options
+
+
+def prepare_data(
+        df_map, df_forms_dict, dictionary, quality_report, map_layout_dict,
+        geojson):
+    '''Add the country and filter columns and build everything the callbacks
+    need from one version of the data, returned as a single dict'''
+    df_map, df_forms_dict, df_countries = batch.add_filter_columns(
+        df_map, df_forms_dict)
+    print(df_countries)
+
+    filter_options = get_filter_options(df_map, df_countries)
+    data = {
+        'data_version': batch.get_data_version(df_map, df_forms_dict),
+        'df_map': df_map,
+        'df_forms_dict': df_forms_dict,
+        'dictionary': dictionary,
+        'quality_report': quality_report,
+        'filter_index': batch.get_filter_index(df_map, df_forms_dict),
+        'df_countries': df_countries,
+        'map_counts': batch.get_map_counts(
+            df_map, filter_options['age_options']),
+        'filter_options': filter_options,
+        'geojson': geojson,
+        'map_figure': create_map(
+            df_countries, map_layout_dict, geojson=geojson)}
+    return data
+
+
+# Data holders created in this process, so that a server can start their
+# refresh threads itself (see start_all_data_refresh)
+data_holders = []
+
+
+def create_data_holder(
+        data, load_function=None, refresh_interval=None, name=None,
+        registry=None, evict_function=None, trigger_file=None):
+    '''Create a holder for the current version of the data. If
+    refresh_interval (in seconds) is given, the data is rebuilt with
+    load_function in a background thread at this interval, and replaced if
+    it has changed. If trigger_file is given, the data is also rebuilt soon
+    after this file is touched (see request_data_refresh). If data is None,
+    it is loaded with load_function when first used. If a project registry
+    is given, the holder is added to it when its data is used, and may be
+    evicted (see mark_data_active).'''
+    data_holder = {
+        'current': data,
+        'load_function': load_function,
+        'refresh_interval': refresh_interval,
+        'trigger_file': trigger_file,
+        'swap_lock': threading.Lock(),
+        'load_lock': threading.Lock(),
+        'load_error': None,
+        'refresh_lock': threading.Lock(),
+        'start_lock': threading.Lock(),
+        'refresh_pid': None,
+        'loaded_pid': os.getpid() if data is not None else None,
+        'on_refresh': None,
+        'name': name,
+        'registry': registry,
+        'evict_function': evict_function}
+    if (data is not None) and (registry is not None):
+        mark_data_active(registry, data_holder)
+    data_holders.append(data_holder)
+    return data_holder
+
+
+def load_current_data(data_holder):
+    '''Load the data into the holder (with its load lock held)'''
+    print(f'Loading data for {data_holder["name"]}')
+    data = data_holder['load_function']()
+    with data_holder['swap_lock']:
+        data_holder['current'] = data
+        data_holder['loaded_pid'] = os.getpid()
+    return data
+
+
+def get_current_data(data_holder):
+    '''Get the current data, loading it first if it hasn't been loaded yet
+    or was evicted (or waiting for it if it is being loaded)'''
+    data = data_holder['current']
+    if data is None:
+        with data_holder['load_lock']:
+            data = data_holder['current']
+            if data is None:
+                data = load_current_data(data_holder)
+    if data_holder['registry'] is not None:
+        mark_data_active(data_holder['registry'], data_holder)
+    return data
+
+
+def start_data_load(data_holder):
+    '''Get the current data without waiting for it to be loaded. If it
+    hasn't been loaded yet (or was evicted), it is loaded in a background
+    thread and None is returned, so that a page can be served meanwhile
+    (see define_loading_layout).'''
+    data = data_holder['current']
+    if data is not None:
+        if data_holder['registry'] is not None:
+            mark_data_active(data_holder['registry'], data_holder)
+        return data
+    if not data_holder['load_lock'].acquire(blocking=False):
+        # Already being loaded
+        return None
+    if data_holder['current'] is not None:
+        data_holder['load_lock'].release()
+        return start_data_load(data_holder)
+    data_holder['load_error'] = None
+
+    def load_in_background():
+        try:
+            load_current_data(data_holder)
+            if data_holder['registry'] is not None:
+                mark_data_active(data_holder['registry'], data_holder)
+        except Exception as error:
+            print(f'Could not load data for {data_holder["name"]}: {error!r}')
+            data_holder['load_error'] = error
+        finally:
+            data_holder['load_lock'].release()
+
+    thread = threading.Thread(target=load_in_background, daemon=True)
+    thread.start()
+    return None
+
+
+def create_project_registry(max_active=None, min_active_seconds=0):
+    '''Create the registry of projects with data loaded in this process.
+    Beyond max_active projects (None for no limit), the data of the least
+    recently used project is evicted, unless it was used in the last
+    min_active_seconds.'''
+    registry = {
+        'active': OrderedDict(),
+        'last_used': {},
+        'max_active': max_active,
+        'min_active_seconds': min_active_seconds,
+        'lock': threading.Lock()}
+    return registry
+
+
+def mark_data_active(registry, data_holder):
+    '''Mark a project's data as most recently used, evicting the data of
+    least recently used projects beyond the registry's maximum'''
+    evicted = []
+    now = time.time()
+    with registry['lock']:
+        registry['active'][data_holder['name']] = data_holder
+        registry['active'].move_to_end(data_holder['name'])
+        registry['last_used'][data_holder['name']] = now
+        max_active = registry['max_active']
+        while (max_active is not None) and (
+                len(registry['active']) > max(max_active, 1)):
+            name = next(iter(registry['active']))
+            if now - registry['last_used'][name] < (
+                    registry['min_active_seconds']):
+                # The least recently used project is still in use
+                break
+            evicted.append(registry['active'].pop(name))
+    for evicted_holder in evicted:
+        evict_data(evicted_holder)
+    return
+
+
+def evict_data(data_holder):
+    '''Drop a project's data, so it is reloaded when next used. Requests
+    already running keep their reference until they finish.'''
+    with data_holder['swap_lock']:
+        data_holder['current'] = None
+    if data_holder['evict_function'] is not None:
+        data_holder['evict_function']()
+    print(f'Evicted data for {data_holder["name"]}')
+    return
+
+
+def refresh_data(data_holder):
+    '''Rebuild the data and swap it in if it has changed. Requests already
+    running keep the previous version, and cached outputs are not reused
+    because the data version is part of the cache key. The data is rebuilt
+    without holding the swap lock, so requests aren't blocked meanwhile.'''
+    if not data_holder['refresh_lock'].acquire(blocking=False):
+        # Already being refreshed
+        return False
+    try:
+        current = data_holder['current']
+        if current is None:
+            # Not loaded (or evicted), so the next use loads the latest data
+            return False
+        try:
+            data = data_holder['load_function']()
+        except Exception as error:
+            print(f'Could not refresh the data, keeping current: {error!r}')
+            return False
+        if data['data_version'] == current['data_version']:
+            return False
+        with data_holder['swap_lock']:
+            if data_holder['current'] is None:
+                # Evicted while refreshing
+                return False
+            # A single assignment, so callbacks see either the old or new data
+            data_holder['current'] = data
+            data_holder['loaded_pid'] = os.getpid()
+    finally:
+        data_holder['refresh_lock'].release()
+    print(f'Data refreshed to version {data["data_version"][:8]}')
+    if data_holder['on_refresh'] is not None:
+        data_holder['on_refresh']()
+    return True
+
+
+def request_data_refresh(data_holder):
+    '''Ask for the data to be refreshed soon, by touching the trigger file.
+    This works across processes: the data is refreshed by whichever process
+    loaded it (see start_data_refresh).'''
+    with open(data_holder['trigger_file'], 'a'):
+        os.utime(data_holder['trigger_file'])
+    return
+
+
+def get_trigger_time(data_holder):
+    try:
+        return os.path.getmtime(data_holder['trigger_file'])
+    except (TypeError, OSError):
+        return 0
+
+
+def start_data_refresh(data_holder, trigger_check_interval=5):
+    '''Start the refresh thread in this process, if not already started.
+    Threads don't survive a fork, so this is called from each server process
+    (e.g. each gunicorn worker) rather than at import. The data is only
+    refreshed by the process that loaded it: data loaded by the gunicorn
+    master before the workers were forked is refreshed in the master, which
+    then reloads the workers so they share the new data (see
+    gunicorn.conf.py), rather than each worker rebuilding its own copy.'''
+    if (data_holder['refresh_interval'] is None) and (
+            data_holder['trigger_file'] is None):
+        return
+    if data_holder['refresh_pid'] == os.getpid():
+        return
+    with data_holder['start_lock']:
+        if data_holder['refresh_pid'] == os.getpid():
+            return
+        data_holder['refresh_pid'] = os.getpid()
+
+    refresh_interval = data_holder['refresh_interval']
+    sleep_interval = refresh_interval
+    if data_holder['trigger_file'] is not None:
+        sleep_interval = trigger_check_interval
+        if refresh_interval is not None:
+            sleep_interval = min(refresh_interval, trigger_check_interval)
+
+    def refresh_loop():
+        last_refresh = time.time()
+        while True:
+            time.sleep(sleep_interval)
+            if data_holder['loaded_pid'] != os.getpid():
+                continue
+            due = (refresh_interval is not None) and (
+                time.time() - last_refresh >= refresh_interval)
+            triggered = get_trigger_time(data_holder) > last_refresh
+            if due or triggered:
+                last_refresh = time.time()
+                refresh_data(data_holder)
+
+    thread = threading.Thread(target=refresh_loop, daemon=True)
+    thread.start()
+    return
+
+
+def start_all_data_refresh(on_refresh=None):
+    '''Start the refresh threads for every project in this process. Used by
+    the gunicorn master, where on_refresh reloads the workers.'''
+    for data_holder in data_holders:
+        data_holder['on_refresh'] = on_refresh
+        start_data_refresh(data_holder)
+    return
+
+
 ############################################
 # Main
 ############################################
 
 
-def main():
-    # app.run_server(debug=True, host='0.0.0.0', port='8080')
-    print('Starting VERTEX')
+def create_project_app(
+        init_project_path, server=True, url_base_pathname=None,
+        project_registry=None):
+    '''Create the dashboard app for a project. To serve several projects
+    from one process, pass the same Flask server and project registry for
+    each project, with a different url_base_pathname. The insight panels are
+    then imported under the project name, and the data is only loaded when
+    the project is first opened and may be evicted when other projects are
+    used (see create_project_registry).'''
     app = dash.Dash(
         __name__,
+        server=server,
+        url_base_pathname=url_base_pathname,
         external_stylesheets=[dbc.themes.BOOTSTRAP],
         suppress_callback_exceptions=True)
 
@@ -1049,77 +1827,25 @@ def main():
     # except Exception:
     #     print('Password not required')
 
-    config_defaults = {
-        'project_name': None,
-        'map_layout_center_latitude': 6,
-        'map_layout_center_longitude': -75,
-        'map_layout_zoom': 1.7,
-        'save_public_outputs': False,
-        'save_base_files_to_public_path': False,
-        'public_path': 'PUBLIC/',
-        'save_filtered_public_outputs': False,
-        'insight_panels_path': 'insight_panels/',
-        'insight_panels': [],
-    }
+    config_defaults = batch.get_config_defaults()
 
     # projects_path, init_project_path = get_project_path()
-    config_dict = get_config(init_project_path, config_defaults)
+    config_dict = batch.get_config(init_project_path, config_defaults)
 
+    namespace = None
+    if project_registry is not None:
+        namespace = get_project_key(init_project_path)
     insight_panels_path = os.path.join(
         init_project_path, config_dict['insight_panels_path'])
-    insight_panels, buttons = get_insight_panels(
-        config_dict, insight_panels_path)
+    insight_panels, buttons = batch.get_insight_panels(
+        config_dict, insight_panels_path, namespace=namespace)
 
-    api_url = config_dict['api_url']
-    api_key = config_dict['api_key']
-    get_data_from_api = (api_url is not None) and (api_key is not None)
-
-    if get_data_from_api:
-        # get_data_kwargs = {}
-        print('Retrieving data from the API')
-        df_map, df_forms_dict, dictionary, quality_report = (
-            getRC.get_redcap_data(api_url, api_key))  # **get_data_kwargs
-
-    if get_data_from_api is False:
-        try:
-            vertex_dataframes_path = os.path.join(
-                init_project_path, config_dict['vertex_dataframes_path'])
-            vertex_dataframes = os.listdir(vertex_dataframes_path)
-            df_map = pd.read_csv(
-                os.path.join(vertex_dataframes_path, 'df_map.csv'))
-            dictionary = pd.read_csv(
-                os.path.join(vertex_dataframes_path, 'vertex_dictionary.csv'))
-            # dictionary = dictionary.fillna('')
-            if 'quality_report.json' in vertex_dataframes:
-                quality_report_file = os.path.join(
-                    vertex_dataframes_path, 'quality_report.json')
-                with open(quality_report_file, 'r') as json_data:
-                    quality_report = json.load(json_data)
-            else:
-                quality_report = {}
-            exclude_files = ('df_map.csv', 'vertex_dictionary.csv')
-            vertex_dataframes = [
-                file for file in vertex_dataframes
-                if file.endswith('.csv') and (file not in exclude_files)]
-            df_forms_dict = {
-                k.split('.csv')[0]: pd.read_csv(
-                    os.path.join(vertex_dataframes_path, k))
-                for k in vertex_dataframes}
-        except Exception:
-            print('Could not load the VERTEX dataframes.')
-            raise
-
-    df_map_with_countries = merge_data_with_countries(df_map)
-    df_countries = get_countries(df_map_with_countries)
-    print(df_countries)
-
-    filter_columns_dict = {
-        'subjid': 'subjid',
-        'demog_sex': 'filters_sex',
-        'demog_age': 'filters_age',
-        'country_iso': 'filters_country',
-        'outco_binary_outcome': 'filters_outcome'
-    }
+    get_data_from_api = (config_dict['api_url'] is not None) and (
+        config_dict['api_key'] is not None)
+    save_vertex_dataframes = get_data_from_api and (
+        config_dict['save_vertex_dataframes'])
+    vertex_dataframes_path = os.path.join(
+        init_project_path, config_dict['vertex_dataframes_path'])
 
     map_style = ['open-street-map', 'carto-positron']
     map_layout_dict = dict(
@@ -1131,93 +1857,209 @@ def main():
         margin={'r': 0, 't': 0, 'l': 0, 'b': 0},
     )
 
-    fig = create_map(df_countries, map_layout_dict)
+    # Cache static assets such as the map geometry in the browser for a day
+    app.server.config['SEND_FILE_MAX_AGE_DEFAULT'] = 24 * 60 * 60
+    geojson = get_geojson_url(app, config_dict['map_resolution'])
+
+    def load_function():
+        return prepare_data(
+            *batch.load_data(config_dict, init_project_path), map_layout_dict,
+            geojson)
+
+    # Outputs saved at startup need the data, so these projects aren't lazy
+    lazy_load = (project_registry is not None) and not (
+        save_vertex_dataframes or config_dict['save_public_outputs'])
+    data = None
+    if lazy_load is False:
+        df_map, df_forms_dict, dictionary, quality_report = batch.load_data(
+            config_dict, init_project_path)
+        if save_vertex_dataframes:
+            print(f'Saving VERTEX dataframes to "{vertex_dataframes_path}"')
+            getRC.save_vertex_dataframes(
+                vertex_dataframes_path, df_map, df_forms_dict,
+                dictionary, quality_report)
+        data = prepare_data(
+            df_map, df_forms_dict, dictionary, quality_report,
+            map_layout_dict, geojson)
+
+    visuals_cache_path = config_dict['visuals_cache_path']
+    if visuals_cache_path is not None:
+        visuals_cache_path = os.path.join(
+            init_project_path, visuals_cache_path)
+    visuals_cache = create_visuals_cache(
+        max_entries=config_dict['visuals_cache_size'],
+        max_size_mb=config_dict['visuals_cache_max_mb'],
+        spill_path=visuals_cache_path,
+        max_spill_mb=config_dict['visuals_cache_spill_max_mb'])
+    background_jobs = None
+    if len(config_dict['background_insight_panels']) > 0:
+        background_jobs_path = None
+        if visuals_cache_path is not None:
+            background_jobs_path = os.path.join(
+                visuals_cache_path, 'background_jobs')
+        background_jobs = create_background_jobs(
+            insight_panels_path,
+            max_workers=config_dict['background_workers'],
+            namespace=namespace, path=background_jobs_path)
+
+    def evict_function():
+        clear_visuals_cache(visuals_cache)
+        if background_jobs is not None:
+            stop_background_jobs(background_jobs)
+        return
+
+    # Touching this file (or requesting the refresh URL below) refreshes the
+    # data without waiting for the next periodic refresh
+    trigger_file = None
+    refresh_token = config_dict['data_refresh_token']
+    if (config_dict['data_refresh_interval'] is not None) or (
+            refresh_token is not None):
+        trigger_file = os.path.join(init_project_path, '.refresh_data')
+    data_holder = create_data_holder(
+        data, load_function=load_function,
+        refresh_interval=config_dict['data_refresh_interval'],
+        name=namespace, registry=project_registry,
+        evict_function=evict_function, trigger_file=trigger_file)
+    app.server.before_request(lambda: start_data_refresh(data_holder))
+
+    if refresh_token is not None:
+        # For example, as the URL of a REDCap Data Entry Trigger, with the
+        # token as a query parameter
+        def refresh_endpoint():
+            token = flask.request.values.get('token', '')
+            if not hmac.compare_digest(token, refresh_token):
+                return 'Invalid token', 403
+            request_data_refresh(data_holder)
+            return 'Data refresh requested', 202
+
+        app.server.add_url_rule(
+            app.config.routes_pathname_prefix + 'refresh-data',
+            endpoint=f'refresh_data_{namespace}',
+            view_func=refresh_endpoint, methods=['GET', 'POST'])
+
+    def serve_layout():
+        # Called on each page load, so new data also updates the map and
+        # filter options
+        request_prefix = app.config.routes_pathname_prefix
+        if flask.has_request_context() and not (
+                flask.request.path.startswith(request_prefix)):
+            # Dash checks the layout of every app on a server at the first
+            # request, which shouldn't load the data for every project
+            return html.Div()
+        data = start_data_load(data_holder)
+        if data is None:
+            return define_loading_layout(config_dict['project_name'])
+        app_layout = define_app_layout(
+            data['map_figure'], buttons, data['filter_options'],
+            map_layout_dict, config_dict['project_name'])
+        return app_layout
+
+    app.layout = serve_layout
 
-    sex_options = [
-        {'label': 'Male', 'value': 'Male'},
-        {'label': 'Female', 'value': 'Female'},
-        {'label': 'Other / Unknown', 'value': 'Other / Unknown'}]
+    @app.callback(
+        Output('project-content', 'children'),
+        [Input('loading-interval', 'n_intervals')])
+    def show_loaded_layout(n_intervals):
+        # Replace the loading page once the data has been loaded
+        data = start_data_load(data_holder)
+        if data is None:
+            if data_holder['load_error'] is not None:
+                return html.P(
+                    'The data could not be loaded, please try again later.')
+            return dash.no_update
+        app_layout = define_app_layout(
+            data['map_figure'], buttons, data['filter_options'],
+            map_layout_dict, config_dict['project_name'])
+        return app_layout
 
-    max_age = max((100, df_map['demog_age'].max()))
-    age_options = {'min': 0, 'max': max_age, 'step': 10}
-    age_range = range(
-        age_options['min'], age_options['max'] + 1, age_options['step'])
-    age_options['marks'] = {ii: str(ii) for ii in age_range}
-    age_options['value'] = [age_options['min'], age_options['max']]
+    register_callbacks(
+        app, insight_panels, data_holder, init_project_path,
+        config_dict['save_filtered_public_outputs'],
+        visuals_cache=visuals_cache, background_jobs=background_jobs,
+        background_insight_panels=config_dict['background_insight_panels'])
 
-    country_options = [
-        {'label': x[1], 'value': x[0]}
-        for x in df_countries.sort_values(by='country_iso').values]
+    if config_dict['save_public_outputs']:
+        data = get_current_data(data_holder)
+        public_path = os.path.join(
+            init_project_path, config_dict['public_path'])
+        batch.save_public_outputs(
+            config_dict, public_path, buttons, insight_panels,
+            data['df_map'], data['df_forms_dict'], data['dictionary'],
+            data['quality_report'], data['df_countries'],
+            data_version=data['data_version'])
+    return app
 
-    outcome_options = [
-        {'label': 'Death', 'value': 'Death'},
-        {'label': 'Censored', 'value': 'Censored'},
-        {'label': 'Discharged', 'value': 'Discharged'}
-    ]
 
-    filter_options = {
-        'sex_options': sex_options, 'age_options': age_options,
-        'country_options': country_options, 'outcome_options': outcome_options}
+def get_project_key(init_project_path):
+    '''Get the name of a project folder, used in its URL and to namespace
+    its insight panels'''
+    project_key = os.path.basename(os.path.normpath(init_project_path))
+    return project_key
 
-    app.layout = define_app_layout(
-        fig, buttons, filter_options,
-        map_layout_dict, config_dict['project_name'])
 
-    df_filters = df_map_with_countries[filter_columns_dict.keys()].rename(
-        columns=filter_columns_dict)
+def get_project_paths():
+    '''Get the projects to serve, from the VERTEX_PROJECT_PATHS environment
+    variable (paths separated by os.pathsep) or else init_project_paths'''
+    project_paths = init_project_paths
+    if os.environ.get('VERTEX_PROJECT_PATHS'):
+        project_paths = [
+            x for x in os.environ['VERTEX_PROJECT_PATHS'].split(os.pathsep)
+            if len(x) > 0]
+    return project_paths
 
-    df_map = pd.merge(
-        df_map_with_countries, df_filters, on='subjid', how='left')
-    df_forms_dict = {
-        form: pd.merge(df_form, df_filters, on='subjid', how='left')
-        for form, df_form in df_forms_dict.items()}
 
-    register_callbacks(
-        app, insight_panels, df_map,
-        df_forms_dict, dictionary, quality_report, filter_options,
-        init_project_path, config_dict['save_filtered_public_outputs'])
+def get_max_active_projects():
+    max_active = max_active_projects
+    if os.environ.get('VERTEX_MAX_ACTIVE_PROJECTS'):
+        max_active = int(os.environ['VERTEX_MAX_ACTIVE_PROJECTS'])
+    return max_active
 
-    if config_dict['save_public_outputs']:
-        public_path = os.path.join(
-            init_project_path, config_dict['public_path'])
-        print(f'Saving files for public dashboard to "{public_path}"')
-        os.makedirs(
-            os.path.dirname(os.path.join(public_path, '')), exist_ok=True)
-        os.makedirs(
-            os.path.dirname(os.path.join(public_path, 'data', '')),
-            exist_ok=True)
-        for ip in config_dict['insight_panels']:
-            os.makedirs(
-                os.path.dirname(os.path.join(public_path, 'data', ip, '')),
-                exist_ok=True)
-        buttons = get_visuals(
-            buttons, insight_panels,
-            df_map=df_map, df_forms_dict=df_forms_dict,
-            dictionary=dictionary, quality_report=quality_report,
-            filepath=os.path.join(public_path, 'data', ''))
-        os.makedirs(os.path.dirname(public_path), exist_ok=True)
-        if config_dict['save_base_files_to_public_path']:
-            shutil.copy('descriptive_dashboard_public.py', public_path)
-            shutil.copy('IsaricDraw.py', public_path)
-            shutil.copy('requirements.txt', public_path)
-            assets_path = os.path.join(public_path, 'assets/')
-            os.makedirs(os.path.dirname(assets_path), exist_ok=True)
-            shutil.copytree('assets', assets_path, dirs_exist_ok=True)
-        metadata_file = os.path.join(
-            public_path, 'data/dashboard_metadata.txt')
-        with open(metadata_file, 'w') as metadata:
-            metadata.write(repr(buttons))
-        data_file = os.path.join(public_path, 'data/dashboard_data.csv')
-        df_countries.to_csv(data_file, index=False)
-        config_json_file = os.path.join(
-            public_path, 'public_config_file.json')
-        with open(config_json_file, 'w') as file:
-            save_config_keys = [
-                'project_name', 'map_layout_center_latitude',
-                'map_layout_center_longitude', 'map_layout_zoom']
-            save_config_dict = {k: config_dict[k] for k in save_config_keys}
-            json.dump(save_config_dict, file)
-    return app
+
+def get_min_active_seconds():
+    min_active = min_active_seconds
+    if os.environ.get('VERTEX_MIN_ACTIVE_SECONDS'):
+        min_active = float(os.environ['VERTEX_MIN_ACTIVE_SECONDS'])
+    return min_active
+
+
+def define_project_index(project_links):
+    '''Page at the root URL with a link to each project'''
+    items = ''.join(
+        f'<li><a href="{url}">{label}</a></li>'
+        for url, label in project_links)
+    index = (
+        '<!DOCTYPE html><html><head><title>VERTEX</title></head><body>'
+        f'<h1>VERTEX</h1><ul>{items}</ul></body></html>')
+    return index
+
+
+def main():
+    # app.run_server(debug=True, host='0.0.0.0', port='8080')
+    print('Starting VERTEX')
+    project_paths = get_project_paths()
+    if len(project_paths) == 0:
+        app = create_project_app(init_project_path)
+        return app
+
+    # Several projects, each a Dash app at /<project folder>/ on one server
+    server = flask.Flask(__name__)
+    project_registry = create_project_registry(
+        get_max_active_projects(), get_min_active_seconds())
+    apps = []
+    project_links = []
+    for project_path in project_paths:
+        project_path = os.path.join(project_path, '')
+        project_key = get_project_key(project_path)
+        url_base_pathname = f'/{project_key}/'
+        print(f'Adding project {project_key} at {url_base_pathname}')
+        apps.append(create_project_app(
+            project_path, server=server, url_base_pathname=url_base_pathname,
+            project_registry=project_registry))
+        project_links.append((url_base_pathname, project_key))
+
+    index = define_project_index(project_links)
+    server.add_url_rule('/', 'index', lambda: index)
+    return apps[0]
 
 
 if __name__ == '__main__':
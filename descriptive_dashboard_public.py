@@ -9,6 +9,8 @@ import plotly.graph_objs as go
 import sys
 import IsaricDraw as idw
 import os
+import ast
+import threading
 
 ############################################
 # ARGUMENTS
@@ -90,14 +92,15 @@ def get_map_colorscale(
     return custom_scale
 
 
-def create_map(df_countries, map_layout_dict=None):
-    geojson = 'https://raw.githubusercontent.com/johan/world.geo.json/master/'
-    geojson = geojson + 'countries.geo.json'
-
+def create_map(
+        df_countries, map_layout_dict=None,
+        geojson='/assets/geojson/countries_high.json'):
     map_colorscale = get_map_colorscale(df_countries)
 
+    # Features in the bundled geojson have the ISO 3166 alpha-3 code as id
     fig = go.Figure(go.Choroplethmapbox(
         geojson=geojson,
+        featureidkey='id',
         locations=df_countries['country_iso'],
         z=df_countries['country_count'],
         text=df_countries['country_name'],
@@ -129,7 +132,7 @@ def define_menu(buttons, project_name=None):
         size='xl'
     )
     menu = pd.DataFrame(data=buttons)
-    menu.drop(columns=['visuals'], inplace=True)
+    menu.drop(columns=['visuals'], inplace=True, errors='ignore')
     menu_items = []
     cont = 0
     for item in menu['item'].unique():
@@ -258,31 +261,32 @@ def get_visuals(path, buttons):
     #         new_file['fig_arguments']['save_inputs'] = False
     #         visuals[fig_id] = fig_fun(data, **new_file['fig_arguments'])
 
-    visuals = {}
-    for ii in range(len(buttons)):
-        suffix = buttons[ii]['suffix']
-        metadata_files = os.listdir(os.path.join(path, suffix))
-        metadata_files = [
-            file for file in metadata_files if file.endswith('.txt')]
-        for file in metadata_files:
-            new_file_path = os.path.join(path, suffix, file)
-            with open(new_file_path, 'r', encoding='latin-1') as f:
-                new_file = eval(f.read())
-            fig_id = new_file['fig_id']
-            data = tuple(
-                pd.read_csv(os.path.join(path, name))
-                for name in new_file['fig_data'])
-            data = data[0] if (len(data) == 1) else data
-            fig_fun = eval('idw.' + new_file['fig_name'])
-            new_file['fig_arguments']['save_inputs'] = False
-            visuals[fig_id] = fig_fun(data, **new_file['fig_arguments'])
-
     for ii in range(len(buttons)):
-        buttons[ii]['visuals'] = tuple(
-            [visuals[id] for id in buttons[ii]['graph_ids']])
+        buttons[ii]['visuals'] = get_button_visuals(path, buttons[ii])
     return buttons
 
 
+def get_button_visuals(path, button):
+    # Figures are loaded from the saved plotly json where available, and only
+    # recreated from their data otherwise
+    visuals = tuple(
+        idw.load_figure_from_file(path, id) for id in button['graph_ids'])
+    return visuals
+
+
+def get_metadata(path):
+    metadata_file = os.path.join(path, 'dashboard_metadata.json')
+    if os.path.exists(metadata_file):
+        with open(metadata_file, 'r') as f:
+            metadata = json.load(f)
+    else:
+        # Files saved by earlier versions
+        metadata_file = os.path.join(path, 'dashboard_metadata.txt')
+        with open(metadata_file, 'r') as f:
+            metadata = ast.literal_eval(f.read())
+    return metadata
+
+
 ############################################
 # Modal creation
 ############################################
@@ -427,7 +431,12 @@ def define_footer_modal(instructions, about):
 
 
 def register_callbacks(
-        app, buttons):
+        app, buttons, path):
+    '''If the buttons don't include visuals (lazy loading), the visuals for
+    each insight panel are loaded from path when it is first opened and kept
+    for later requests.'''
+    visuals_lock = threading.Lock()
+
     @app.callback(
         [
             Output('modal', 'is_open', allow_duplicate=True),
@@ -450,6 +459,10 @@ def register_callbacks(
             button_ind = [
                 ii for ii in range(len(buttons))
                 if buttons[ii]['suffix'] == suffix][0]
+            with visuals_lock:
+                if 'visuals' not in buttons[button_ind]:
+                    buttons[button_ind]['visuals'] = get_button_visuals(
+                        path, buttons[button_ind])
             visuals = buttons[button_ind]['visuals']
             button = {
                 'item': buttons[button_ind]['item'],
@@ -485,14 +498,19 @@ def main():
         'map_layout_center_latitude': 6,
         'map_layout_center_longidute': -75,
         'map_layout_zoom': 1.7,
+        'map_resolution': 'high',
+        'lazy_load_panels': True,
     }
 
     config_dict = get_config(filepath, config_defaults)
 
-    metadata_file = os.path.join(filepath, 'data', 'dashboard_metadata.txt')
-    with open(metadata_file, 'r') as f:
-        metadata = eval(f.read())
-    buttons = get_visuals(os.path.join(filepath, 'data/', ''), metadata)
+    data_path = os.path.join(filepath, 'data/', '')
+    metadata = get_metadata(data_path)
+    if config_dict['lazy_load_panels']:
+        # Visuals are loaded when each insight panel is first opened
+        buttons = metadata
+    else:
+        buttons = get_visuals(data_path, metadata)
 
     data_file = os.path.join(filepath, 'data', 'dashboard_data.csv')
     df_countries = pd.read_csv(data_file)
@@ -505,17 +523,16 @@ def main():
             'lon': config_dict['map_layout_center_longitude']},
         margin={'r': 0, 't': 0, 'l': 0, 'b': 0},
     )
-    fig = create_map(df_countries, map_layout_dict)
-    # geojson = 'https://raw.githubusercontent.com/johan/world.geo.json/'
-    # geojson = geojson + 'master/countries.geo.json'
-    # fig = go.Figure(
-    #     go.Choroplethmapbox(geojson=geojson),
-    #     layout=map_layout_dict)
+    # Cache static assets such as the map geometry in the browser for a day
+    app.server.config['SEND_FILE_MAX_AGE_DEFAULT'] = 24 * 60 * 60
+    geojson = app.get_asset_url(
+        f'geojson/countries_{config_dict["map_resolution"]}.json')
+    fig = create_map(df_countries, map_layout_dict, geojson=geojson)
 
     app.layout = define_app_layout(
         fig, buttons, map_layout_dict, config_dict['project_name'])
 
-    register_callbacks(app, buttons)
+    register_callbacks(app, buttons, data_path)
 
     app.run_server(debug=True)
     return
@@ -2,6 +2,12 @@ import requests
 import pandas as pd
 import numpy as np
 import io
+import os
+import json
+import re
+import functools
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 
 ############################################
@@ -9,8 +15,96 @@ import io
 ############################################
 
 
-def get_records(redcap_url, redcap_api_key):
-    '''Fetch records from the REDCap API'''
+def get_session(pool_size=10):
+    '''Create a requests.Session with a connection pool, so that several
+    API calls (possibly from different threads) can reuse connections'''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def post_request(redcap_url, conex, session=None):
+    '''Make a POST request to the REDCap API, using the session if given'''
+    if session is None:
+        response = requests.post(redcap_url, data=conex)
+    else:
+        response = session.post(redcap_url, data=conex)
+    return response
+
+
+def get_record_ids(
+        redcap_url, redcap_api_key, record_id_field='subjid',
+        date_range_begin=None, session=None):
+    '''Fetch the list of unique record IDs from the REDCap API, by exporting
+    only the record ID field. If date_range_begin is given, only records
+    created or modified after this time are listed.'''
+    conex = {
+        'token': redcap_api_key,
+        'content': 'record',
+        'action': 'export',
+        'format': 'csv',
+        'type': 'flat',
+        'fields[0]': record_id_field,
+        'returnFormat': 'json'
+    }
+    if date_range_begin is not None:
+        conex['dateRangeBegin'] = date_range_begin
+    response = post_request(redcap_url, conex, session=session)
+    df = pd.read_csv(
+        io.StringIO(response.text), keep_default_na=False, dtype=str)
+    record_ids = df[record_id_field].drop_duplicates().tolist()
+    return record_ids
+
+
+def infer_column_types(df):
+    '''Convert str columns to numeric where every value is numeric, matching
+    the type inference of pd.read_csv(..., keep_default_na=False) on the
+    full export (i.e. columns with any empty cells remain str)'''
+    for col in df.columns:
+        if (df[col] == '').any():
+            continue
+        try:
+            df[col] = pd.to_numeric(df[col])
+        except (ValueError, TypeError):
+            pass
+    return df
+
+
+def iter_record_batches(
+        redcap_url, redcap_api_key, conex, batch_size,
+        record_id_field='subjid', session=None):
+    '''Export records from the REDCap API in batches of batch_size record IDs.
+    Yields one dataframe (of str columns) per batch, so that only one batch
+    is held in each response body.'''
+    record_ids = get_record_ids(
+        redcap_url, redcap_api_key, record_id_field,
+        date_range_begin=conex.get('dateRangeBegin'), session=session)
+    n_batches = -(-len(record_ids) // batch_size)
+    for ii in range(n_batches):
+        batch_ids = record_ids[ii*batch_size:(ii + 1)*batch_size]
+        batch_conex = {
+            **conex,
+            **{f'records[{jj}]': x for jj, x in enumerate(batch_ids)}}
+        response = post_request(redcap_url, batch_conex, session=session)
+        print(
+            f'HTTP Status: {response.status_code} '
+            f'(batch {ii + 1} of {n_batches})')
+        df = pd.read_csv(
+            io.StringIO(response.text), keep_default_na=False, dtype=str)
+        yield df
+
+
+def get_records(
+        redcap_url, redcap_api_key, batch_size=None,
+        record_id_field='subjid', date_range_begin=None, session=None):
+    '''Fetch records from the REDCap API. If batch_size is given, first
+    list the record IDs and then export the records in batches of batch_size
+    records, to limit the size of each request. If date_range_begin is given
+    (as 'YYYY-MM-DD HH:MM:SS', in the REDCap server's timezone), only records
+    created or modified after this time are exported.'''
     conex = {
         'token': redcap_api_key,
         'content': 'record',
@@ -25,13 +119,120 @@ def get_records(redcap_url, redcap_api_key):
         'exportDataAccessGroups': 'true',
         'returnFormat': 'json'
     }
-    response = requests.post(redcap_url, data=conex)
-    print('HTTP Status: ' + str(response.status_code))
-    df = pd.read_csv(io.StringIO(response.text), keep_default_na=False)
+    if date_range_begin is not None:
+        conex['dateRangeBegin'] = date_range_begin
+    if batch_size is None:
+        response = post_request(redcap_url, conex, session=session)
+        print('HTTP Status: ' + str(response.status_code))
+        df = pd.read_csv(io.StringIO(response.text), keep_default_na=False)
+    else:
+        df_list = list(iter_record_batches(
+            redcap_url, redcap_api_key, conex, batch_size,
+            record_id_field=record_id_field, session=session))
+        if len(df_list) == 0:
+            return pd.DataFrame(columns=[record_id_field])
+        df = pd.concat(df_list, axis=0, ignore_index=True)
+        df = infer_column_types(df)
     return df
 
 
-def get_data_dictionary(redcap_url, redcap_api_key):
+def merge_records(data, new_data, record_id_field='subjid'):
+    '''Merge newly exported records into previously exported records. All rows
+    of a record in new_data replace the rows of that record in data, and any
+    remaining duplicates of subjid/event/instance keep the newest row.'''
+    key_columns = [
+        record_id_field, 'redcap_event_name',
+        'redcap_repeat_instrument', 'redcap_repeat_instance']
+    keep_ind = (data[record_id_field].isin(new_data[record_id_field]) == 0)
+    data = pd.concat([data.loc[keep_ind], new_data], axis=0, ignore_index=True)
+    key_columns = [col for col in key_columns if col in data.columns]
+    data = data.drop_duplicates(subset=key_columns, keep='last')
+    # Fields added to the project since the last export are empty for the
+    # previously exported records
+    data = data.fillna('').reset_index(drop=True)
+    return data
+
+
+def replace_file(file, write_function):
+    '''Write file by calling write_function with a temporary file name in the
+    same folder, then move it into place. Readers never see a partial file,
+    and each writer has its own temporary file, so concurrent writers (e.g.
+    several gunicorn workers) don't interleave.'''
+    with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(file) or '.',
+            prefix=os.path.basename(file) + '.', suffix='.tmp',
+            delete=False) as temp_file:
+        temp_name = temp_file.name
+    try:
+        write_function(temp_name)
+        os.replace(temp_name, file)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+    return
+
+
+def get_records_incremental(
+        redcap_url, redcap_api_key, snapshot_path, batch_size=None,
+        record_id_field='subjid', session=None, sync_overlap_hours=48):
+    '''Fetch records from the REDCap API, using a local snapshot of the last
+    export. Only records created or modified since the last sync are
+    requested (using dateRangeBegin), and these are merged into the snapshot.
+    If there is no snapshot yet, all records are exported. Records deleted
+    from REDCap are not detected; remove the snapshot to force a full export.
+
+    dateRangeBegin is compared with the REDCap server's clock, which may be
+    behind this machine's clock or in another timezone. The sync time is
+    therefore stored sync_overlap_hours before the local time of the request,
+    so some records are exported again at the next sync (and merged as
+    duplicates) rather than missed.
+
+    Only the API export is incremental. The merged records are returned in
+    full, and get_redcap_data processes all of them again (not only the
+    modified records), because initial_data_processing decides which columns
+    and dictionary rows to keep from the whole dataset.'''
+    records_file = os.path.join(snapshot_path, 'records.csv')
+    sync_file = os.path.join(snapshot_path, 'sync_metadata.json')
+    # Use the time before the request, so that records modified during the
+    # export are requested again at the next sync
+    sync_time = pd.Timestamp.now() - pd.Timedelta(hours=sync_overlap_hours)
+    sync_time = sync_time.strftime('%Y-%m-%d %H:%M:%S')
+    if os.path.exists(records_file) and os.path.exists(sync_file):
+        with open(sync_file, 'r') as json_data:
+            last_sync = json.load(json_data)['last_sync']
+        print(f'Retrieving records modified since {last_sync}')
+        data = pd.read_csv(records_file, keep_default_na=False, dtype=str)
+        new_data = get_records(
+            redcap_url, redcap_api_key, batch_size=batch_size,
+            record_id_field=record_id_field, date_range_begin=last_sync,
+            session=session)
+        print(f'{new_data[record_id_field].nunique()} records modified')
+        if len(new_data) > 0:
+            data = merge_records(
+                data, new_data.astype(str), record_id_field=record_id_field)
+    else:
+        data = get_records(
+            redcap_url, redcap_api_key, batch_size=batch_size,
+            record_id_field=record_id_field, session=session).astype(str)
+
+    # Write to temporary files first so that an interrupted sync doesn't
+    # leave a partial snapshot
+    os.makedirs(snapshot_path, exist_ok=True)
+    replace_file(
+        records_file, lambda name: data.to_csv(name, index=False))
+
+    def write_sync_file(name):
+        with open(name, 'w') as file:
+            json.dump({'last_sync': sync_time}, file)
+        return
+
+    replace_file(sync_file, write_sync_file)
+    data = infer_column_types(data)
+    return data
+
+
+def get_data_dictionary(redcap_url, redcap_api_key, session=None):
     '''Fetch the data dictionary from the REDCap API'''
     conex = {
         'token': redcap_api_key,
@@ -40,14 +241,13 @@ def get_data_dictionary(redcap_url, redcap_api_key):
         'returnFormat': 'json'
     }
     # Make the API request
-    response = requests.post(redcap_url, data=conex)
+    response = post_request(redcap_url, conex, session=session)
     df = pd.read_csv(io.StringIO(response.text), keep_default_na=False)
     return df
 
 
-def get_form_event(redcap_url, redcap_api_key):
-    '''Get events, forms and their mapppings from the REDCap API and merge
-    into a single dataframe.'''
+def get_events(redcap_url, redcap_api_key, session=None):
+    '''Get events from the REDCap API (empty if the project has no events)'''
     conex = {
         'token': redcap_api_key,
         'content': 'event',
@@ -55,14 +255,18 @@ def get_form_event(redcap_url, redcap_api_key):
         'returnFormat': 'json'
     }
     # Make the API request
-    response = requests.post(redcap_url, data=conex)
+    response = post_request(redcap_url, conex, session=session)
     if (response.status_code == 200):
         event = pd.read_csv(io.StringIO(response.text), keep_default_na=False)
     else:
         event_columns = ['event_name', 'arm_num', 'unique_event_name']
         event_columns = event_columns + ['custom_event_label', 'event_id']
         event = pd.DataFrame(columns=event_columns)
+    return event
 
+
+def get_instruments(redcap_url, redcap_api_key, session=None):
+    '''Get instruments (forms) and their labels from the REDCap API'''
     conex = {
         'token': redcap_api_key,
         'content': 'instrument',
@@ -71,7 +275,7 @@ def get_form_event(redcap_url, redcap_api_key):
         'returnFormat': 'json'
     }
     # Make the API request
-    response = requests.post(redcap_url, data=conex)
+    response = post_request(redcap_url, conex, session=session)
     if (response.status_code == 200):
         form = pd.read_csv(io.StringIO(response.text), keep_default_na=False)
         form = form.rename(columns={
@@ -79,7 +283,11 @@ def get_form_event(redcap_url, redcap_api_key):
     else:
         form_columns = ['form', 'form_label']
         form = pd.DataFrame(columns=form_columns)
+    return form
+
 
+def get_form_event_mapping(redcap_url, redcap_api_key, session=None):
+    '''Get the mapping between forms and events from the REDCap API'''
     conex = {
         'token': redcap_api_key,
         'content': 'formEventMapping',
@@ -87,14 +295,19 @@ def get_form_event(redcap_url, redcap_api_key):
         'returnFormat': 'json'
     }
     # Make the API request
-    response = requests.post(redcap_url, data=conex)
+    response = post_request(redcap_url, conex, session=session)
     if (response.status_code == 200):
         form_event = pd.read_csv(
             io.StringIO(response.text), keep_default_na=False)
     else:
         form_event_columns = ['arm_num', 'unique_event_name', 'form']
         form_event = pd.DataFrame(columns=form_event_columns)
+    return form_event
 
+
+def merge_form_event(event, form, form_event):
+    '''Merge events, forms and their mappings into a single dataframe'''
+    form = form.copy()
     form_event = pd.merge(form_event, form, on='form', how='left')
     form.rename(columns={'form': 'form_name'}, inplace=True)
     form_event.rename(columns={'form': 'form_name'}, inplace=True)
@@ -105,7 +318,18 @@ def get_form_event(redcap_url, redcap_api_key):
     return form, form_event
 
 
-def get_missing_data_codes(redcap_url, redcap_api_key):
+def get_form_event(redcap_url, redcap_api_key, session=None):
+    '''Get events, forms and their mapppings from the REDCap API and merge
+    into a single dataframe.'''
+    event = get_events(redcap_url, redcap_api_key, session=session)
+    form = get_instruments(redcap_url, redcap_api_key, session=session)
+    form_event = get_form_event_mapping(
+        redcap_url, redcap_api_key, session=session)
+    form, form_event = merge_form_event(event, form, form_event)
+    return form, form_event
+
+
+def get_missing_data_codes(redcap_url, redcap_api_key, session=None):
     '''Get missing data codes from REDCAP API, using the project metadata'''
     conex = {
         'token': redcap_api_key,
@@ -113,7 +337,7 @@ def get_missing_data_codes(redcap_url, redcap_api_key):
         'format': 'csv',
         'returnFormat': 'json'
     }
-    response = requests.post(redcap_url, data=conex)
+    response = post_request(redcap_url, conex, session=session)
     df = pd.read_csv(io.StringIO(response.text), keep_default_na=False)
     if df['missing_data_codes'].isna().all():
         missing_data_codes = dict()
@@ -125,6 +349,38 @@ def get_missing_data_codes(redcap_url, redcap_api_key):
     return missing_data_codes
 
 
+def get_api_data_concurrently(
+        redcap_url, redcap_api_key, batch_size=None, snapshot_path=None):
+    '''Make all the independent REDCap API calls at the same time, using a
+    thread pool and a shared requests.Session. Returns the records, data
+    dictionary, missing data codes and the form/event tables.'''
+    if snapshot_path is None:
+        records = (get_records, {'batch_size': batch_size})
+    else:
+        records = (
+            get_records_incremental,
+            {'snapshot_path': snapshot_path, 'batch_size': batch_size})
+    api_functions = {
+        'data': records,
+        'dictionary': (get_data_dictionary, {}),
+        'missing_data_codes': (get_missing_data_codes, {}),
+        'event': (get_events, {}),
+        'form': (get_instruments, {}),
+        'form_event': (get_form_event_mapping, {}),
+    }
+    session = get_session(pool_size=len(api_functions))
+    with session, ThreadPoolExecutor(max_workers=len(api_functions)) as pool:
+        futures = {
+            key: pool.submit(
+                function, redcap_url, redcap_api_key,
+                session=session, **kwargs)
+            for key, (function, kwargs) in api_functions.items()}
+        output = {key: future.result() for key, future in futures.items()}
+    output['form'], output['form_event'] = merge_form_event(
+        output['event'], output['form'], output['form_event'])
+    return output
+
+
 ############################################
 # Functions for processing the data dictionary
 ############################################
@@ -334,6 +590,34 @@ def is_unlisted_item(x):
     return output
 
 
+def get_columns_with_only_values(df, values):
+    '''Get the columns where every cell, as a lower case and stripped str, is
+    in values. Only the unique values of each column are compared, so this
+    scales with the number of distinct values rather than with the number of
+    cells.'''
+    values = set(values)
+    ind = [
+        all(str(x).lower().strip() in values for x in pd.unique(df[col]))
+        for col in df.columns]
+    columns = df.columns[np.array(ind, dtype=bool)]
+    return columns
+
+
+def get_unlisted_item_indicators(df, columns, prefix, sep='___'):
+    '''Get True/NaN indicator columns (named prefix + sep + value) for each
+    value that appears in any of the columns, from a stacked long view of
+    these columns. Values are in order of first appearance.'''
+    values = df[columns].reset_index(drop=True).stack()
+    values = values.loc[values.isin(['', 'Other']) == 0]
+    codes, unique_values = pd.factorize(values)
+    indicators = np.full((len(df), len(unique_values)), np.nan, dtype=object)
+    indicators[values.index.get_level_values(0), codes] = True
+    indicators = pd.DataFrame(
+        indicators, index=df.index,
+        columns=[prefix + sep + value for value in unique_values])
+    return indicators, list(unique_values)
+
+
 def combine_unlisted_variables(df, dictionary, sep='___'):
     '''Combine variables that exist in repeated versions of the same question
     (e.g. additional dropdown questions asked after Yes/No/Unknown questions
@@ -350,21 +634,18 @@ def combine_unlisted_variables(df, dictionary, sep='___'):
         k: [v for v in unlisted_item_columns if k in v]
         for k in unlisted_columns}
 
+    # New columns are inserted immediately before their unlisted column,
+    # with all new columns added in a single concat at the end
+    new_columns_dict = {}
+    new_df_list = []
     new_dictionary_list = []
     for ind in unlisted_columns.index:
         column = dictionary.loc[ind, 'field_name']
-        values = df[unlisted_columns_dict[column]].stack().unique()
-        values = [val for val in values if val not in (np.nan, '', 'Other')]
-        new_df = pd.DataFrame(
-            index=df.index,
-            columns=[column + '_item' + sep + x for x in values])
-        for value in values:  # it's too slow...
-            yes_ind = (df[unlisted_columns_dict[column]] == value).any(axis=1)
-            new_df.loc[yes_ind, column + '_item' + sep + value] = True
-        column_loc = df.columns.get_loc(column)
-        df = pd.concat(
-            [df.iloc[:, :column_loc], new_df, df.iloc[:, column_loc:]],
-            axis=1)
+        new_df, values = get_unlisted_item_indicators(
+            df, unlisted_columns_dict[column], column + '_item', sep=sep)
+        new_columns_dict[column] = new_columns_dict.get(column, []) + list(
+            new_df.columns)
+        new_df_list.append(new_df)
         new_dictionary_index = ind + np.linspace(0.1, 0.9, len(values))
         new_dictionary = pd.DataFrame(
             '', columns=dictionary.columns, index=new_dictionary_index)
@@ -381,6 +662,13 @@ def combine_unlisted_variables(df, dictionary, sep='___'):
         new_dictionary['parent'] = column
         new_dictionary['form_name'] = dictionary.loc[ind, 'form_name']
         new_dictionary_list.append(new_dictionary)
+    if len(new_df_list) > 0:
+        columns = []
+        for col in df.columns:
+            columns += new_columns_dict.pop(col, []) + [col]
+        # Any unlisted columns not in the data are added at the end
+        columns += sum(new_columns_dict.values(), [])
+        df = pd.concat([df] + new_df_list, axis=1)[columns]
     dictionary = pd.concat([dictionary] + new_dictionary_list, axis=0)
     dictionary = dictionary.sort_index().reset_index(drop=True)
     return df, dictionary
@@ -416,24 +704,240 @@ def get_branching_logic_variables(branching_logic):
     return var_names
 
 
+branching_logic_token_pattern = re.compile(r'''
+    \s*(?:
+        (?P<variable>\[[^\[\]]+\])|
+        (?P<string>'[^']*'|"[^"]*")|
+        (?P<number>-?\d+(?:\.\d+)?)|
+        (?P<operator><>|!=|>=|<=|=|>|<)|
+        (?P<logical>(?i:and|or)\b)|
+        (?P<bracket>[()])
+    )''', re.VERBOSE)
+
+
+def tokenize_branching_logic(branching_logic):
+    '''Split REDCap branching logic into (token type, token) pairs. Raises a
+    ValueError for anything not supported (e.g. functions, smart variables or
+    event-prefixed variables).'''
+    tokens = []
+    position = 0
+    branching_logic = branching_logic.strip()
+    while position < len(branching_logic):
+        match = branching_logic_token_pattern.match(branching_logic, position)
+        if match is None:
+            raise ValueError(
+                f'Unsupported branching logic: {branching_logic[position:]}')
+        token_type = match.lastgroup
+        token = match.group(token_type)
+        if token_type == 'variable':
+            token = token[1:-1].strip()
+            if (len(tokens) > 0) and (tokens[-1][0] == 'variable'):
+                raise ValueError('Event-prefixed variables are not supported')
+        elif token_type == 'string':
+            token = token[1:-1]
+        elif token_type == 'logical':
+            token = token.lower()
+        tokens.append((token_type, token))
+        position = match.end()
+    return tokens
+
+
+@functools.lru_cache(maxsize=None)
+def compile_branching_logic(branching_logic):
+    '''Parse REDCap branching logic into a nested tuple expression tree:
+    ('or', ...), ('and', ...) or ('compare', operator, left, right), where
+    left and right are ('variable', name) or ('value', str). Each unique
+    expression is only parsed once. Raises a ValueError if unsupported.'''
+    tokens = tokenize_branching_logic(branching_logic)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else (None, None)
+
+    def take(token_type=None):
+        nonlocal position
+        token = peek()
+        if (token[0] is None) or (
+                (token_type is not None) and (token[0] != token_type)):
+            raise ValueError(f'Could not parse branching logic at {token}')
+        position += 1
+        return token
+
+    def parse_operand():
+        token_type, token = take()
+        if token_type == 'variable':
+            return ('variable', token)
+        elif token_type in ('string', 'number'):
+            return ('value', token)
+        raise ValueError(f'Could not parse branching logic at {token}')
+
+    def parse_factor():
+        if peek() == ('bracket', '('):
+            take()
+            output = parse_expression()
+            if take('bracket') != ('bracket', ')'):
+                raise ValueError('Unbalanced brackets in branching logic')
+            return output
+        left = parse_operand()
+        operator = take('operator')[1]
+        right = parse_operand()
+        return ('compare', '<>' if operator == '!=' else operator, left, right)
+
+    def parse_logical(logical, parse_next):
+        output = [parse_next()]
+        while peek() == ('logical', logical):
+            take()
+            output.append(parse_next())
+        return output[0] if len(output) == 1 else (logical, *output)
+
+    def parse_term():
+        return parse_logical('and', parse_factor)
+
+    def parse_expression():
+        return parse_logical('or', parse_term)
+
+    output = parse_expression()
+    if position != len(tokens):
+        raise ValueError(f'Could not parse branching logic at {peek()}')
+    return output
+
+
+def get_choices_dict(dictionary):
+    '''Get a dict of {field_name: {code: label}} for categorical variables,
+    used to compare the label-exported data to the codes in branching logic'''
+    choices_dict = {}
+    categorical_ind = dictionary['field_type'].isin(['radio', 'dropdown'])
+    for _, row in dictionary.loc[categorical_ind].iterrows():
+        answers = str(row['select_choices_or_calculations']).split('|')
+        answers = [x.strip() for x in answers if len(x.strip()) > 0]
+        codes = [x.strip() for x in get_value(answers)]
+        choices_dict[row['field_name']] = dict(zip(codes, get_label(answers)))
+    yesno_ind = (dictionary['field_type'] == 'yesno')
+    choices_dict.update({
+        x: {'1': 'Yes', '0': 'No'}
+        for x in dictionary.loc[yesno_ind, 'field_name']})
+    truefalse_ind = (dictionary['field_type'] == 'truefalse')
+    choices_dict.update({
+        x: {'1': 'True', '0': 'False'}
+        for x in dictionary.loc[truefalse_ind, 'field_name']})
+    return choices_dict
+
+
+def evaluate_branching_logic_comparison(df, expression, choices_dict):
+    '''Evaluate a single comparison from compile_branching_logic across all
+    rows. Empty cells (NaN) compare as an empty string, as in REDCap.'''
+    _, operator, left, right = expression
+    if left[0] == 'value':
+        # Put the variable on the left
+        left, right = right, left
+        operator = {'<': '>', '>': '<', '<=': '>=', '>=': '<='}.get(
+            operator, operator)
+    if (left[0] != 'variable') or (right[0] != 'value'):
+        raise ValueError('Only comparisons of a variable to a value are used')
+    variable, value = left[1], right[1]
+
+    if '(' in variable:
+        # Checkbox variable, e.g. [variable(code)] = '1'. A checkbox option
+        # that isn't in the data was never checked.
+        name, code = variable.rstrip(')').split('(')
+        column = name.strip() + '___' + code.strip().lower()
+        series = df.get(column, pd.Series('Unchecked', index=df.index))
+        value = {'1': 'Checked', '0': 'Unchecked'}.get(value, value)
+    else:
+        # A field that isn't in the data is empty
+        series = df.get(variable, pd.Series(np.nan, index=df.index))
+        value = choices_dict.get(variable, {}).get(value, value)
+
+    if value == '':
+        output = series.notna() if operator == '<>' else series.isna()
+        if operator not in ('=', '<>'):
+            raise ValueError(f'Unsupported comparison to empty: {operator}')
+    elif operator in ('=', '<>'):
+        output = (series.astype(str) == value) & series.notna()
+        if (variable not in choices_dict) and ('(' not in variable):
+            # Numeric fields may be exported as numbers, e.g. 1.0 = '1'
+            numeric_value = pd.to_numeric(pd.Series([value]), errors='coerce')
+            if numeric_value.notna().all():
+                output |= (
+                    pd.to_numeric(series, errors='coerce') ==
+                    numeric_value.iloc[0])
+        if operator == '<>':
+            output = (output == 0)
+    else:
+        series = pd.to_numeric(series, errors='coerce')
+        value = float(value)
+        output = {
+            '<': series < value, '>': series > value,
+            '<=': series <= value, '>=': series >= value}[operator]
+    return output.to_numpy(dtype=bool)
+
+
+def evaluate_branching_logic(df, expression, choices_dict):
+    '''Evaluate an expression tree from compile_branching_logic across all
+    rows of df, returning a boolean numpy array (True if the question was
+    asked)'''
+    if expression[0] == 'compare':
+        return evaluate_branching_logic_comparison(
+            df, expression, choices_dict)
+    outputs = [
+        evaluate_branching_logic(df, x, choices_dict) for x in expression[1:]]
+    if expression[0] == 'and':
+        return np.logical_and.reduce(outputs)
+    return np.logical_or.reduce(outputs)
+
+
+def get_not_asked_mask(df, branching_logic, choices_dict, fallback=None):
+    '''Get a boolean numpy array, True for rows where a question with this
+    branching logic was not asked. Variables not in the data are treated as
+    empty (or unchecked, for checkbox options). If the branching logic can't
+    be evaluated (unsupported syntax), then a row counts as not asked if any
+    variable in the branching logic is missing, and the branching logic is
+    added to the fallback list if given.'''
+    try:
+        expression = compile_branching_logic(branching_logic)
+        mask = (evaluate_branching_logic(df, expression, choices_dict) == 0)
+    except ValueError:
+        if fallback is not None:
+            fallback.append(branching_logic)
+        branching_logic_columns = [
+            col for col in get_branching_logic_variables(branching_logic)
+            if col in df.columns]
+        mask = df[branching_logic_columns].isna().any(axis=1).to_numpy()
+    return mask
+
+
 def resolve_checkbox_branching_logic(df, dictionary):
     '''By default, a cell is marked as 'Unchecked' in the absence of the
     positive, even if the question was not asked to the subjid. If the question
     was not asked to the subjid because of the branching logic, then set this
-    to be NaN instead. This does not completely check the branching logic,
-    which is a data quality issue!'''
-    checkbox_ind = dictionary.loc[(dictionary['field_type'] == 'checkbox')]
-    branching_logic_variables = (
-        dictionary['branching_logic'].apply(get_branching_logic_variables))
-    for ind in checkbox_ind.index:
-        branching_logic_columns = [
-            col for col in df.columns
-            if col in branching_logic_variables.loc[ind]]
-        remove_ind = df[branching_logic_columns].isna().any(axis=1)
-        checkbox_columns = [
-            col for col in df.columns
-            if (col.split('___')[0] == dictionary.loc[ind, 'field_name'])]
+    to be NaN instead. The branching logic is evaluated once for each unique
+    expression, across all rows (see get_not_asked_mask). Expressions that
+    can't be evaluated are listed in a printed warning.'''
+    checkbox_dictionary = dictionary.loc[(
+        (dictionary['field_type'] == 'checkbox') &
+        (dictionary['branching_logic'].fillna('').str.strip() != ''))]
+    if checkbox_dictionary.empty:
+        return df
+    choices_dict = get_choices_dict(dictionary)
+    prefixes = pd.Series(df.columns.str.split('___').str[0], index=df.columns)
+    checkbox_columns_dict = prefixes.groupby(prefixes).groups
+    fallback = []
+    for branching_logic, group in checkbox_dictionary.groupby(
+            'branching_logic', sort=False):
+        checkbox_columns = sum([
+            list(checkbox_columns_dict.get(x, []))
+            for x in group['field_name']], [])
+        if len(checkbox_columns) == 0:
+            continue
+        remove_ind = get_not_asked_mask(
+            df, branching_logic, choices_dict, fallback=fallback)
         df.loc[remove_ind, checkbox_columns] = np.nan
+    if len(fallback) > 0:
+        print(
+            'Branching logic not supported, using missing values instead '
+            'to find checkbox questions that were not asked:')
+        for branching_logic in fallback:
+            print(f'    {branching_logic}')
     return df
 
 
@@ -462,68 +966,125 @@ def map_variable(variable, mapping_dict, other_value_str='Other / Unknown'):
     return variable
 
 
-def homogenise_variables(df, dictionary):
+@functools.lru_cache(maxsize=None)
+def load_conversion_rules(path='assets/conversion_table.csv'):
+    '''Load and validate the unit conversion table once, grouping the rules
+    by variable. Returns a dict of {variable: rules} and a list of the table
+    rows that were skipped, each with the reason.'''
+    conversion_table = pd.read_csv(path)
+    required_columns = [
+        'from_unit', 'to_unit', 'variable', 'variable_unit',
+        'conversion_factor']
+    missing_columns = [
+        col for col in required_columns
+        if col not in conversion_table.columns]
+    if len(missing_columns) > 0:
+        raise ValueError(
+            f'{path} is missing columns: {", ".join(missing_columns)}')
+    conversion_table['conversion_factor'] = pd.to_numeric(
+        conversion_table['conversion_factor'], errors='coerce')
+
+    rules = {}
+    skipped = []
+    for row in conversion_table.to_dict('records'):
+        required_values = [row[col] for col in required_columns[:-1]]
+        if any(pd.isna(x) for x in required_values):
+            skipped.append({**row, 'reason': 'missing values in table'})
+            continue
+        variable_rules = rules.setdefault(row['variable'], {
+            'unit_column': row['variable_unit'], 'factors': {},
+            'to_units': {}, 'percentage_of': {}})
+        if row['variable_unit'] != variable_rules['unit_column']:
+            skipped.append({**row, 'reason': 'inconsistent unit column'})
+            continue
+        if row['from_unit'] in variable_rules['to_units']:
+            skipped.append({**row, 'reason': 'duplicate from_unit'})
+            continue
+        # Absolute lymphocyte/neutrophil counts are converted to a percentage
+        # of the total WBC count, rather than by a conversion factor
+        check_ind = (
+            row['variable'] in ['labs_lymphocyte', 'labs_neutrophil'] and
+            row['from_unit'] == '10^9/L' and
+            row['to_unit'] == '%')
+        if check_ind:
+            variable_rules['percentage_of'][row['from_unit']] = 'labs_wbccount'
+        elif pd.notna(row['conversion_factor']):
+            variable_rules['factors'][row['from_unit']] = (
+                row['conversion_factor'])
+        variable_rules['to_units'][row['from_unit']] = row['to_unit']
+    return rules, skipped
+
+
+def apply_conversion_rules(df, dictionary, rules):
+    '''Apply unit conversion rules (from load_conversion_rules) to df, in one
+    vectorized pass per variable. Returns df, dictionary (with each distinct
+    target unit added once to the field label) and a list of variables that
+    were skipped because they are not in df.'''
+    skipped = []
+    for variable, variable_rules in rules.items():
+        unit_col = variable_rules['unit_column']
+        if (variable not in df.columns) or (unit_col not in df.columns):
+            skipped.append(variable)
+            continue
+        values = pd.to_numeric(df[variable], errors='coerce')
+        units = df[unit_col]
+
+        for from_unit, total_col in variable_rules['percentage_of'].items():
+            if total_col not in df.columns:
+                continue
+            total = pd.to_numeric(df[total_col], errors='coerce')
+            df[total_col] = total
+            mask = (units == from_unit) & values.notna() & total.notna()
+            values = values.where(mask == 0, 100*(values / total))
+            units = units.where(
+                mask == 0, variable_rules['to_units'][from_unit])
+
+        factors = units.map(variable_rules['factors'])
+        values = values.where(factors.isna(), values*factors)
+        unit_changes = {
+            k: v for k, v in variable_rules['to_units'].items()
+            if k not in variable_rules['percentage_of']}
+        units = units.where(
+            units.isin(unit_changes.keys()) == 0, units.map(unit_changes))
+        df[variable] = values
+        df[unit_col] = units
+
+        # Each target unit is added to the label once per variable (before,
+        # it was added once per conversion row, so rules sharing a target
+        # unit repeated it, e.g. 'Creatinine (mg/dL) (mg/dL)')
+        to_units = pd.unique(pd.Series(list(unit_changes.values())))
+        dictionary_ind = (dictionary['field_name'] == variable)
+        for to_unit in to_units:
+            dictionary.loc[dictionary_ind, 'field_label'] += f' ({to_unit})'
+    return df, dictionary, skipped
+
+
+def homogenise_variables(
+        df, dictionary, conversion_table_path='assets/conversion_table.csv'):
     '''
     Converts variables in a DataFrame based on a conversion table.
 
     Parameters:
     df: DataFrame containing values and their units.
-    conversion_table: DataFrame containing conversion specifications.
+    dictionary: VERTEX dictionary, the target unit is added to field labels.
+    conversion_table_path: csv file containing conversion specifications.
 
     Returns:
     pd.DataFrame: DataFrame with all specified values converted to the
     desired units.
     '''
-    conversion_table = pd.read_csv('assets/conversion_table.csv')
-    for index, row in conversion_table.iterrows():
-        from_unit = row['from_unit']
-        to_unit = row['to_unit']
-        value_col = row['variable']
-        unit_col = row['variable_unit']
-        conversion_factor = row['conversion_factor']
-
-        try:
-            # Ensure that the value column is numeric
-            df.loc[:, value_col] = pd.to_numeric(
-                df[value_col], errors='coerce')
-
-            # Check if the variable is labs_lymphocyte or labs_neutrophil
-            check_ind = (
-                value_col in ['labs_lymphocyte', 'labs_neutrophil'] and
-                from_unit == '10^9/L' and
-                to_unit == '%')
-            if check_ind:
-                # Convert absolute count to percentage using total WBC count
-                total_wbc_col = 'labs_wbccount'
-                if total_wbc_col in df.columns:
-                    # Ensure the total WBC count column is numeric
-                    df.loc[:, total_wbc_col] = pd.to_numeric(
-                        df[total_wbc_col], errors='coerce')
-                    # Apply conversion only to non-empty values
-                    mask = (
-                        (df[unit_col] == from_unit) &
-                        df[value_col].notna() &
-                        df[total_wbc_col].notna())
-                    df.loc[mask, value_col] = 100*(
-                        df.loc[mask, value_col] / df.loc[mask, total_wbc_col])
-                    df.loc[mask, unit_col] = to_unit
-                continue
-
-            # Only apply the conversion if the factor is not NaN and the
-            # value_col is not empty
-            if not pd.isna(conversion_factor):
-                mask = (df[unit_col] == from_unit) & df[value_col].notna()
-                # Apply the conversion
-                df.loc[mask, value_col] *= conversion_factor
-
-            # Set all units to the target unit
-            df.loc[df[unit_col] == from_unit, unit_col] = to_unit
-
-            dictionary_ind = (dictionary['field_name'] == value_col)
-            dictionary.loc[dictionary_ind, 'field_label'] += f' ({to_unit})'
-        except Exception:
-            pass
-    if 'demog_age' not in conversion_table['variable']:
+    rules, skipped_rules = load_conversion_rules(conversion_table_path)
+    df, dictionary, skipped_variables = apply_conversion_rules(
+        df, dictionary, rules)
+    for rule in skipped_rules:
+        print(
+            f'Skipped unit conversion for {rule["variable"]} '
+            f'({rule["from_unit"]} to {rule["to_unit"]}): {rule["reason"]}')
+    if len(skipped_variables) > 0:
+        print(
+            'Skipped unit conversion for variables not in the data: ' +
+            ', '.join(skipped_variables))
+    if 'demog_age' not in rules:
         try:
             df = harmonise_age(df)
         except Exception:
@@ -565,20 +1126,19 @@ def initial_data_processing(data, dictionary, missing_data_codes):
     # data code column is 'Checked'
     data = replace_with_nan_for_missing_code_checkbox(data, missing_data_codes)
 
+    # Convert 'Unchecked' to NaN when a checkbox question wasn't asked
+    # to a subjid because of their previous answers (i.e. the branching logic)
+    # This is done before removing columns below, as branching logic may
+    # refer to these columns
+    data = resolve_checkbox_branching_logic(data, dictionary)
+
     # Remove columns where all the data is a negative answer option
     # (or missing answer)
     remove_values = ['', 'no', 'never smoked', 'unchecked', 'nan']
     remove_values += [x.lower() for x in missing_data_codes.keys()]
-    remove_columns = data.columns[data.astype(str).map(
-        lambda x: (x.lower().strip() in remove_values)).all(axis=0)]
+    remove_columns = get_columns_with_only_values(data, remove_values)
     data = data[[col for col in data.columns if col not in remove_columns]]
 
-    # Convert 'Unchecked' to NaN when a checkbox question wasn't asked
-    # to a subjid because of their previous answers (i.e. the branching logic)
-    # TODO: this needs updating based on branching logic values,
-    # not just the variables themselves
-    data = resolve_checkbox_branching_logic(data, dictionary)
-
     # Add a python dict of choice options to the dictionary
     new_dictionary = dictionary.copy()
     # Remove rows corresponding to the deleted columns of the data (ignore
@@ -633,25 +1193,119 @@ def initial_data_processing(data, dictionary, missing_data_codes):
     return data, new_dictionary
 
 
-def get_df_map(data, dictionary):
-    '''Convert single-event rows into one row per patient.'''
+############################################
+# Form membership
+############################################
+
+
+def get_form_index(data):
+    '''Get a boolean dataframe with one row for each row of data and one
+    column for each form, True if the row includes that form. This parses
+    the comma-separated form_name of each row once, so that rows for any form
+    can then be selected without splitting strings again.
+
+    The index is aligned to the rows of the long-format data, which is not
+    kept after get_redcap_data, so it is not passed to insight panels. Panels
+    get df_forms_dict, which is this index already applied (one dataframe per
+    form), and can find the patients with a form from its subjid column.'''
+    # Only a few distinct combinations of forms occur, so parse each of these
+    # once and expand back to the rows of data
+    codes, uniques = pd.factorize(data['form_name'].fillna(''))
+    unique_index = pd.Series(uniques).str.get_dummies(sep=',').astype(bool)
+    form_index = pd.DataFrame(
+        unique_index.to_numpy()[codes],
+        columns=unique_index.columns, index=data.index)
+    return form_index
+
+
+def get_form_rows(form_index, forms):
+    '''Get a boolean series, True for rows that include any of forms, using
+    the form index from get_form_index'''
+    output = form_index.reindex(columns=forms, fill_value=False).any(axis=1)
+    return output
+
+
+############################################
+# Quality checks
+############################################
+
+
+def check_presentation_or_outcome(data, dictionary, form_index):
+    '''Patients without any presentation or outcome forms (these are not
+    included in df_map)'''
+    ind = get_form_rows(form_index, ['presentation', 'outcome'])
+    missing_ind = (data['subjid'].isin(data.loc[ind, 'subjid']) == 0)
+    output = {
+        'check_id': 'presentation_or_outcome',
+        'severity': 'error',
+        'description': (
+            'QUALITY CHECK 1: Patient does not have Presentation or Outcome '
+            'forms'),
+        'records': data.loc[missing_ind, 'subjid'].unique().tolist(),
+    }
+    return output
+
+
+def check_repeated_presentation(data, dictionary, form_index):
+    '''Patients with more than one row that includes the presentation form
+    (only the first non-missing value of each variable is used in df_map)'''
+    ind = get_form_rows(form_index, ['presentation'])
+    subjid = data.loc[ind, 'subjid']
+    output = {
+        'check_id': 'repeated_presentation',
+        'severity': 'warning',
+        'description': (
+            'QUALITY CHECK 2: Patient has more than one Presentation form'),
+        'records': subjid.loc[subjid.duplicated()].unique().tolist(),
+    }
+    return output
+
+
+# Each quality check takes (data, dictionary, form_index), where data is the
+# processed long-format data with a form_name column and form_index is from
+# get_form_index(data), and returns one result dict with keys check_id,
+# severity ('error' if the records are excluded from df_map, otherwise
+# 'warning'), description and records (the affected subjids). Add new checks
+# to this list.
+quality_checks = [
+    check_presentation_or_outcome,
+    check_repeated_presentation,
+]
+
+
+def run_quality_checks(data, dictionary, form_index=None, checks=None):
+    '''Run each quality check, returning a list of the result dicts'''
+    if form_index is None:
+        form_index = get_form_index(data)
+    if checks is None:
+        checks = quality_checks
+    results = [check(data, dictionary, form_index) for check in checks]
+    return results
+
+
+def get_quality_report(results):
+    '''Convert quality check results into the quality_report used by the
+    dashboard insight panels, a dict of {description: list of subjids}'''
+    quality_report = {
+        result['description']: result['records'] for result in results}
+    return quality_report
+
+
+def get_df_map(data, dictionary, form_index=None):
+    '''Convert single-event rows into one row per patient. form_index is
+    from get_form_index(data), and is created if not given.'''
+    if form_index is None:
+        form_index = get_form_index(data)
     df_map = data.copy()
     forms = ['presentation', 'daily', 'outcome']
     columns = dictionary.loc[
         dictionary['form_name'].isin(forms), 'field_name'].tolist()
     columns = [col for col in columns if col in df_map.columns]
-    ind = data['form_name'].apply(
-        lambda x: any(y in x.split(',') for y in ['presentation', 'outcome']))
+    ind = get_form_rows(form_index, ['presentation', 'outcome'])
 
-    ###########################################################################
-    ###########################################################################
-    # QUALITY CHECK 1 Patients has either Presentation or Outcome forms
-    missing_id_QC1 = [
-        id for id in data['subjid'].values if
-        id not in df_map.loc[ind, 'subjid'].values]
-
-    qc = 'QUALITY CHECK 1: Patient does not have Presentation or Outcome forms'
-    quality_report = {qc: missing_id_QC1}
+    quality_results = run_quality_checks(
+        data, dictionary, form_index=form_index)
+    quality_report = get_quality_report(quality_results)
 
     df_map = df_map.loc[ind, columns]
     # # ## TODO: Should this remove all columns with no data, or just those
@@ -665,12 +1319,15 @@ def get_df_map(data, dictionary):
     error = 'At least one variable exists in several non-repeating forms'
     assert test, error
     '''
-    # Merge into one row per subjid
-    df_map = df_map.set_index('subjid').groupby(level=0).bfill()
+    # Merge into one row per subjid, taking the first non-missing value of
+    # each variable from the presentation/outcome rows for that subjid
     df_map = df_map.drop(
         columns=[col for col in df_map.columns if 'redcap' in col])
-    df_map = df_map.reset_index().drop_duplicates('subjid')
-    df_map = df_map.reset_index(drop=True)
+    df_map = df_map.groupby('subjid', sort=False, dropna=False).first()
+    df_map = df_map.reset_index()
+    # Object columns with no values for a subjid are None, use NaN instead
+    columns = df_map.select_dtypes(include='object').columns
+    df_map[columns] = df_map[columns].where(df_map[columns].notna(), np.nan)
 
     other_value_ind = (df_map['demog_sex'].isin(['Male', 'Female']) == 0)
     df_map.loc[other_value_ind, 'demog_sex'] = 'Other / Unknown'
@@ -699,7 +1356,11 @@ def get_df_map(data, dictionary):
     return df_map, dictionary, quality_report
 
 
-def get_df_forms(data, dictionary):
+def get_df_forms(data, dictionary, form_index=None):
+    '''Split data into one dataframe per form, using form_index from
+    get_form_index(data) (created if not given).'''
+    if form_index is None:
+        form_index = get_form_index(data)
     forms = dictionary['form_name'].unique()
     df_forms_dict = {}
     for form in forms:
@@ -708,16 +1369,39 @@ def get_df_forms(data, dictionary):
         columns = [col for col in columns if col in data.columns]
         if 'subjid' not in columns:
             columns = ['subjid'] + columns
-        ind = data['form_name'].apply(lambda x: form in x.split(','))
+        ind = get_form_rows(form_index, [form])
         df_forms_dict[form] = data.loc[ind, columns].reset_index(drop=True)
     return df_forms_dict
 
 
-def get_redcap_data(redcap_url, redcap_api_key, country_mapping=None):
-    '''Get data from REDCap API and transform into analysis-ready dataframes'''
-    data = get_records(redcap_url, redcap_api_key)
-    dictionary = get_data_dictionary(redcap_url, redcap_api_key)
-    missing_data_codes = get_missing_data_codes(redcap_url, redcap_api_key)
+def get_redcap_data(
+        redcap_url, redcap_api_key, country_mapping=None, batch_size=None,
+        concurrent=False, snapshot_path=None):
+    '''Get data from REDCap API and transform into analysis-ready dataframes.
+    If batch_size is given, records are exported in batches of this many
+    records (see get_records). If concurrent is True, all API calls are made
+    at the same time over a shared connection pool. If snapshot_path is given,
+    only records modified since the last export are requested and merged into
+    the snapshot stored there (see get_records_incremental). All records are
+    then processed, not only the modified ones.'''
+    if concurrent:
+        api_data = get_api_data_concurrently(
+            redcap_url, redcap_api_key, batch_size=batch_size,
+            snapshot_path=snapshot_path)
+        data = api_data['data']
+        dictionary = api_data['dictionary']
+        missing_data_codes = api_data['missing_data_codes']
+    elif snapshot_path is not None:
+        data = get_records_incremental(
+            redcap_url, redcap_api_key, snapshot_path, batch_size=batch_size)
+        dictionary = get_data_dictionary(redcap_url, redcap_api_key)
+        missing_data_codes = get_missing_data_codes(
+            redcap_url, redcap_api_key)
+    else:
+        data = get_records(redcap_url, redcap_api_key, batch_size=batch_size)
+        dictionary = get_data_dictionary(redcap_url, redcap_api_key)
+        missing_data_codes = get_missing_data_codes(
+            redcap_url, redcap_api_key)
 
     data, new_dictionary = initial_data_processing(
         data, dictionary, missing_data_codes)
@@ -728,7 +1412,10 @@ def get_redcap_data(redcap_url, redcap_api_key, country_mapping=None):
     data = pd.concat([data, pd.DataFrame(columns=redcap_columns)], axis=1)
 
     # Get forms and events from the API
-    form, form_event = get_form_event(redcap_url, redcap_api_key)
+    if concurrent:
+        form, form_event = api_data['form'], api_data['form_event']
+    else:
+        form, form_event = get_form_event(redcap_url, redcap_api_key)
     # Convert repeating forms from label to name
     form_dict = dict(zip(form['form_label'], form['form_name']))
     data.loc[:, 'form_name'] = data['redcap_repeat_instrument'].map(form_dict)
@@ -737,8 +1424,10 @@ def get_redcap_data(redcap_url, redcap_api_key, country_mapping=None):
     data.loc[data['form_name'].isna(), 'form_name'] = (
         data.loc[data['form_name'].isna(), 'redcap_event_name'].map(form_dict))
     data = data.loc[data['form_name'].notna()].reset_index(drop=True)
-    df_map, new_dictionary, quality_report = get_df_map(data, new_dictionary)
-    df_forms_dict = get_df_forms(data, new_dictionary)
+    form_index = get_form_index(data)
+    df_map, new_dictionary, quality_report = get_df_map(
+        data, new_dictionary, form_index=form_index)
+    df_forms_dict = get_df_forms(data, new_dictionary, form_index=form_index)
 
     if country_mapping is None:
         dag = data[['subjid', 'redcap_data_access_group']].drop_duplicates()
@@ -769,6 +1458,151 @@ def get_redcap_data(redcap_url, redcap_api_key, country_mapping=None):
     return df_map, df_forms_dict, new_dictionary, quality_report
 
 
+############################################
+# Functions for saving and loading the VERTEX dataframes
+############################################
+
+
+def write_vertex_table(df, path, name, file_format='parquet'):
+    '''Write a dataframe to path, as parquet if possible or else as csv
+    (parquet needs pyarrow, which is in requirements.txt, and columns with a
+    single type). Any file for the same table in the other format is
+    removed. Returns the manifest entry for the file, including the dtypes
+    needed to restore it from csv.'''
+    output = None
+    if file_format == 'parquet':
+        filename = name + '.parquet'
+        try:
+            replace_file(
+                os.path.join(path, filename),
+                lambda file: df.to_parquet(file, index=False))
+            output = {'file': filename, 'format': 'parquet'}
+        except (ImportError, TypeError, ValueError):
+            print(f'Could not save {name} as parquet, saving as csv instead')
+    if output is None:
+        filename = name + '.csv'
+        replace_file(
+            os.path.join(path, filename),
+            lambda file: df.to_csv(file, index=False))
+        output = {'file': filename, 'format': 'csv'}
+    for extension in ('.parquet', '.csv'):
+        other_file = os.path.join(path, name + extension)
+        if (name + extension != filename) and os.path.exists(other_file):
+            os.remove(other_file)
+    output['dtypes'] = {col: str(dtype) for col, dtype in df.dtypes.items()}
+    return output
+
+
+def write_json_file(file, content, indent=1):
+    def write_function(name):
+        with open(name, 'w') as json_file:
+            json.dump(content, json_file, indent=indent)
+        return
+    replace_file(file, write_function)
+    return
+
+
+def read_vertex_table(path, entry):
+    '''Read a dataframe written by write_vertex_table, restoring datetime
+    and categorical columns if read from csv'''
+    file = os.path.join(path, entry['file'])
+    if entry['format'] == 'parquet':
+        df = pd.read_parquet(file)
+        # Missing values in object columns are read as None, use NaN instead
+        # to match the rest of the pipeline
+        columns = df.select_dtypes(include='object').columns
+        df[columns] = df[columns].where(df[columns].notna(), np.nan)
+    else:
+        df = pd.read_csv(file)
+        for col, dtype in entry['dtypes'].items():
+            if col not in df.columns:
+                continue
+            if dtype.startswith('datetime64'):
+                df[col] = pd.to_datetime(df[col], errors='coerce')
+            elif dtype == 'category':
+                df[col] = df[col].astype('category')
+    return df
+
+
+def save_vertex_dataframes(
+        path, df_map, df_forms_dict, dictionary, quality_report,
+        file_format='parquet'):
+    '''Save the outputs of get_redcap_data to path, with a manifest
+    (vertex_manifest.json) listing each file, its format and its dtypes.
+    The manifest is marked incomplete while the files are written, so a
+    save interrupted part way is not loaded as a consistent snapshot.'''
+    os.makedirs(path, exist_ok=True)
+    manifest_file = os.path.join(path, 'vertex_manifest.json')
+    write_json_file(manifest_file, {'format_version': 1, 'complete': False})
+    manifest = {
+        'format_version': 1,
+        'complete': True,
+        'df_map': write_vertex_table(df_map, path, 'df_map', file_format),
+        'dictionary': write_vertex_table(
+            dictionary, path, 'vertex_dictionary', file_format),
+        'forms': {
+            form: write_vertex_table(df_form, path, form, file_format)
+            for form, df_form in df_forms_dict.items()},
+        'quality_report': 'quality_report.json',
+    }
+    write_json_file(
+        os.path.join(path, 'quality_report.json'), quality_report, indent=None)
+    # Mark the manifest complete once all of the files have been written
+    write_json_file(manifest_file, manifest)
+    return manifest
+
+
+def load_vertex_dataframes_from_csv(path):
+    '''Load VERTEX dataframes saved as csv without a manifest: df_map.csv,
+    vertex_dictionary.csv, optionally quality_report.json, and one csv file
+    for each form. Date columns are converted using the dictionary.'''
+    vertex_dataframes = os.listdir(path)
+    df_map = pd.read_csv(os.path.join(path, 'df_map.csv'))
+    dictionary = pd.read_csv(os.path.join(path, 'vertex_dictionary.csv'))
+    # dictionary = dictionary.fillna('')
+    if 'quality_report.json' in vertex_dataframes:
+        quality_report_file = os.path.join(path, 'quality_report.json')
+        with open(quality_report_file, 'r') as json_data:
+            quality_report = json.load(json_data)
+    else:
+        quality_report = {}
+    exclude_files = ('df_map.csv', 'vertex_dictionary.csv')
+    vertex_dataframes = [
+        file for file in vertex_dataframes
+        if file.endswith('.csv') and (file not in exclude_files)]
+    df_forms_dict = {
+        k.split('.csv')[0]: pd.read_csv(os.path.join(path, k))
+        for k in vertex_dataframes}
+
+    date_columns = dictionary.loc[
+        (dictionary['field_type'] == 'date'), 'field_name'].tolist()
+    for df in [df_map] + list(df_forms_dict.values()):
+        columns = [col for col in date_columns if col in df.columns]
+        df[columns] = df[columns].apply(pd.to_datetime, errors='coerce')
+    return df_map, df_forms_dict, dictionary, quality_report
+
+
+def load_vertex_dataframes(path):
+    '''Load VERTEX dataframes saved by save_vertex_dataframes, or from csv
+    files if there is no manifest in path'''
+    manifest_file = os.path.join(path, 'vertex_manifest.json')
+    if not os.path.exists(manifest_file):
+        return load_vertex_dataframes_from_csv(path)
+    with open(manifest_file, 'r') as json_data:
+        manifest = json.load(json_data)
+    if manifest.get('complete', True) is False:
+        raise ValueError(
+            f'The VERTEX dataframes in "{path}" were not completely saved, '
+            'please save them again')
+    df_map = read_vertex_table(path, manifest['df_map'])
+    dictionary = read_vertex_table(path, manifest['dictionary'])
+    df_forms_dict = {
+        form: read_vertex_table(path, entry)
+        for form, entry in manifest['forms'].items()}
+    with open(os.path.join(path, manifest['quality_report']), 'r') as file:
+        quality_report = json.load(file)
+    return df_map, df_forms_dict, dictionary, quality_report
+
 # def convert_fixed_date_events_to_repeating_event(df, event_prefix='Day '):
 #     new_columns = ['days_since_adm']
 #     if 'redcap_repeat_instance' not in df.columns:
@@ -0,0 +1,55 @@
+'''Gunicorn settings for the VERTEX dashboard (used by the Dockerfile).
+
+The app is loaded once in the master process before the workers are forked,
+so the data is only retrieved and processed once. Workers then share the
+master's copy of the dataframes through copy-on-write memory, rather than
+each worker holding its own copy. The number of workers can be set with the
+WEB_CONCURRENCY environment variable.
+
+If the data is refreshed (data_refresh_interval or data_refresh_token in the
+project config), this is also done once, in the master, which then reloads
+the workers gracefully so that they are forked again with the new data.
+
+When serving several projects (VERTEX_PROJECT_PATHS), project data is loaded
+on first use in each worker instead, and VERTEX_MAX_ACTIVE_PROJECTS limits
+the number of projects with data in memory in each worker (see
+VERTEX_MIN_ACTIVE_SECONDS). Data loaded in a worker is refreshed by that
+worker.
+
+Insight panels run as background jobs (background_insight_panels) record
+their jobs and results in files shared by the workers (in visuals_cache_path
+if set, otherwise a temporary folder created before the workers are forked),
+so a request polling a job can be answered by any worker, and the job is not
+started again by another worker.'''
+import gc
+import os
+import signal
+
+bind = '0.0.0.0:8050'
+
+# Run descriptive_dashboard.main() in the master, not in each worker
+preload_app = True
+
+# Pages are served while project data loads in the background, but callbacks
+# can still wait for it (e.g. after the data was evicted), or for a slow
+# insight panel, so allow longer than gunicorn's default of 30 seconds
+timeout = 300
+
+
+def when_ready(server):
+    import descriptive_dashboard
+    master_pid = os.getpid()
+
+    def reload_workers():
+        # Workers forked from the master inherit its data holders, so only
+        # the master reloads them
+        if os.getpid() == master_pid:
+            gc.freeze()
+            os.kill(master_pid, signal.SIGHUP)
+        return
+
+    descriptive_dashboard.start_all_data_refresh(on_refresh=reload_workers)
+    # Move the loaded data to the permanent generation, so that garbage
+    # collection in the workers doesn't write to (and so copy) these pages
+    gc.freeze()
+    return
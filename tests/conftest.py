@@ -0,0 +1,12 @@
+'''Tests for the VERTEX modules, run from the repository root with
+
+    python -m pytest tests
+'''
+import os
+import sys
+
+# The modules are imported from the repository root, and read files such as
+# assets/countries.csv relative to it
+repository_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_path)
+os.chdir(repository_path)
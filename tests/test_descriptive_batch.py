@@ -0,0 +1,44 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+import descriptive_batch as batch
+
+
+def get_filter_data():
+    '''Patients with ages either side of and on the age slider steps, and at
+    the maximum of the slider'''
+    age = [0, 29.5, 30, 30.5, 39.99, 40, 100, 102, 104, np.nan]
+    n = len(age)
+    df_map = pd.DataFrame({
+        'subjid': [str(ii) for ii in range(n)],
+        'country_iso': ['GBR', 'FRA'] * (n // 2),
+        'country_name': ['United Kingdom', 'France'] * (n // 2),
+        'filters_country': ['GBR', 'FRA'] * (n // 2),
+        'filters_sex': ['Male', 'Female', 'Female', 'Male', 'Male'] * 2,
+        'filters_outcome': ['Death', 'Discharged'] * (n // 2),
+        'filters_age': age})
+    age_options = {'min': 0, 'max': 104, 'step': 10}
+    return df_map, age_options
+
+
+def test_map_counts_match_filtered_data():
+    df_map, age_options = get_filter_data()
+    map_counts = batch.get_map_counts(df_map, age_options)
+    filter_index = batch.get_filter_index(df_map, {})
+    slider_values = list(range(0, 101, 10)) + [104]
+    genders = ['Male', 'Female']
+    outcomes = ['Death', 'Discharged']
+    countries = ['GBR', 'FRA']
+    for age_range in itertools.combinations_with_replacement(
+            slider_values, 2):
+        df_countries = batch.get_filtered_countries(
+            map_counts, genders, age_range, outcomes, countries)
+        positions = batch.get_filter_positions(
+            filter_index, genders, age_range, outcomes, countries)
+        expected = df_map.take(positions).groupby('country_iso').size()
+        counts = df_countries.set_index('country_iso')['country_count']
+        pd.testing.assert_series_equal(
+            counts.sort_index(), expected.sort_index(),
+            check_names=False, check_dtype=False)
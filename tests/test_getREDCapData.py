@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+import getREDCapData as getRC
+
+
+def get_checkbox_data():
+    '''A checkbox question (sympt_sym) only asked if an option of another
+    checkbox (expo_sx) is checked. No patient has expo_sx(2), so this column
+    only contains negative answers and is removed during processing.'''
+    dictionary = pd.DataFrame({
+        'field_name': ['subjid', 'demog_sex', 'expo_sx', 'sympt_sym'],
+        'form_name': ['presentation'] * 4,
+        'section_header': [''] * 4,
+        'field_type': ['text', 'radio', 'checkbox', 'checkbox'],
+        'field_label': ['ID', 'Sex', 'Exposure', 'Symptoms'],
+        'select_choices_or_calculations': [
+            '', '1, Male | 2, Female', '1, Farm | 2, Market',
+            '1, Fever | 2, Cough'],
+        'branching_logic': [
+            '', '', '', "[expo_sx(1)]='1' or [expo_sx(2)]='1'"]})
+    data = pd.DataFrame({
+        'subjid': ['a', 'b', 'c'],
+        'demog_sex': ['Male', 'Female', 'Male'],
+        'expo_sx___1': ['Checked', 'Unchecked', 'Unchecked'],
+        'expo_sx___2': ['Unchecked', 'Unchecked', 'Unchecked'],
+        'sympt_sym___1': ['Checked', 'Unchecked', 'Unchecked'],
+        'sympt_sym___2': ['Unchecked', 'Checked', 'Unchecked']})
+    return data, dictionary
+
+
+def test_branching_logic_with_removed_checkbox_column():
+    data, dictionary = get_checkbox_data()
+    data, _ = getRC.initial_data_processing(data, dictionary, {})
+    assert 'expo_sx___Market' not in data.columns
+    # Only patient a was asked, so the others are missing, not False
+    assert data['sympt_sym___Fever'].tolist()[0] is True
+    assert data['sympt_sym___Fever'].iloc[1:].isna().all()
+
+
+def test_not_asked_mask_with_missing_columns():
+    data, dictionary = get_checkbox_data()
+    data = data.drop(columns=['expo_sx___2'])
+    choices_dict = getRC.get_choices_dict(dictionary)
+    fallback = []
+    mask = getRC.get_not_asked_mask(
+        data, "[expo_sx(1)]='1' or [expo_sx(2)]='1'", choices_dict,
+        fallback=fallback)
+    np.testing.assert_array_equal(mask, [False, True, True])
+    # A field not in the data is empty
+    mask = getRC.get_not_asked_mask(
+        data, "[demog_sex]='1' and [expo_weight]=''", choices_dict,
+        fallback=fallback)
+    np.testing.assert_array_equal(mask, [False, True, False])
+    assert fallback == []
+
+
+def test_unsupported_branching_logic_is_listed():
+    data, dictionary = get_checkbox_data()
+    choices_dict = getRC.get_choices_dict(dictionary)
+    fallback = []
+    branching_logic = "datediff([expo_date], 'today', 'd') < 14"
+    getRC.get_not_asked_mask(
+        data, branching_logic, choices_dict, fallback=fallback)
+    assert fallback == [branching_logic]
+
+
+def test_quality_checks():
+    data = pd.DataFrame({
+        'subjid': ['a', 'a', 'b', 'b', 'c', 'c'],
+        'form_name': [
+            'presentation', 'presentation,daily', 'presentation', 'outcome',
+            'daily', 'daily']})
+    results = getRC.run_quality_checks(data, None)
+    records = {result['check_id']: result['records'] for result in results}
+    assert records == {
+        'presentation_or_outcome': ['c'], 'repeated_presentation': ['a']}
+    assert all(
+        result['severity'] in ('error', 'warning') for result in results)
+    quality_report = getRC.get_quality_report(results)
+    assert quality_report == {
+        result['description']: result['records'] for result in results}